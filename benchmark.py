@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from floorgen import addGeneratorArguments, generateFloor, generatorOptions
+from floorplanner import (
+    Cable,
+    CableArray,
+    StatementIndex,
+    collectMacros,
+    drawFullRoom,
+    drawRoom,
+    expandMacros,
+    numberLines,
+    parseConditionals,
+    parseLoops,
+    parseMacros,
+    parseMath,
+    parseRooms,
+    parseVariables,
+    splitMacros,
+)
+
+
+# Fixed-point loop expansion as main() used to run it, kept as a baseline
+def legacyParseLoops(lines):
+    looped_src = []
+    current_index = None
+    current_times = 0
+    done = False
+    met_loops = 0
+    i = 0
+    while not done:
+        if i >= len(lines):
+            done = True
+            continue
+        line = lines[i]
+        if current_index:
+            l = 1
+            for j in range(current_times):
+                l = 1
+                met_loops = 1
+                while True:
+                    loop_line = lines[i + l]
+                    if loop_line.startswith("new loop"):
+                        met_loops += 1
+                    if loop_line.startswith("stop loop"):
+                        met_loops -= 1
+                    if loop_line.startswith("stop loop") and met_loops <= 1:
+                        looped_src.append(loop_line)
+                        break
+                    replaced = (
+                        loop_line.replace("@" + current_index + "@", str(j)) + "\n"
+                    )
+                    looped_src.append(replaced)
+                    l += 1
+            for k in range(i + l + 1, len(lines)):
+                looped_src.append(lines[k])
+            break
+        if line.startswith("new loop"):
+            if not all([keyword in line for keyword in ["times", "index", "equals"]]):
+                assert False, "Invalid loop syntax"
+            met_loops = 1
+            keywords = line.split(" ")[2::2]
+            values = line.split(" ")[3::2]
+            zipped = {k: v for k, v in zip(keywords, values)}
+            if int(zipped["times"]) < 0:
+                assert False, "Loop cannot run less than 0 times"
+            current_index = zipped["index"]
+            current_times = int(zipped["times"])
+        elif line.startswith("stop loop"):
+            current_index = None
+            i += 1
+        else:
+            looped_src.append(line)
+            i += 1
+
+    return looped_src
+
+
+def legacyExpandLoops(src):
+    while True:
+        tmp_src = legacyParseLoops(src)
+        if tmp_src != src:
+            src = tmp_src
+            continue
+        break
+    return src
+
+
+def loopSource(loops, times, depth):
+    lines = []
+    for n in range(loops):
+        for d in range(depth):
+            lines.append(
+                "new loop times " + str(times) + " index i" + str(d) + " equals\n"
+            )
+        lines.append(
+            "new cable room "
+            + str(n)
+            + " type H size 1 from 0,@i"
+            + str(depth - 1)
+            + "@ to 8,@i"
+            + str(depth - 1)
+            + "@\n"
+        )
+        for d in range(depth):
+            lines.append("stop loop\n")
+    return lines
+
+
+# Macro expansion as it used to be, every line against every macro name
+def legacyExpandMacros(lines, macros):
+    macroed_src = []
+    for line in lines:
+        for k, v in macros.items():
+            if line.startswith(k):
+                keywords = line.split(" ")[1::2]
+                values = line.split(" ")[2::2]
+                zipped = {k: v for k, v in zip(keywords, values)}
+                line = "\n".join(v["lines"])
+                for p in v["params"]:
+                    line = line.replace("@" + p + "@", zipped[p])
+        macroed_src.append(line)
+    return macroed_src
+
+
+def macroSource(macros, calls):
+    # Names of equal length, so that none of them is a prefix of another and
+    # the legacy expansion gives the same result
+    names = ["m{:06d}".format(m) for m in range(macros)]
+    lines = []
+    for name in names:
+        lines.append("new macro " + name + " params r,x equals")
+        lines.append("new box room @r@ name " + name + " anchor @x@,1")
+        lines.append("new cable room @r@ type V size 1 from @x@,1 to @x@,5")
+        lines.append("stop macro " + name)
+    for n in range(calls):
+        lines.append(names[n % macros] + " r 1 x " + str(n % 9))
+        lines.append("new door room 1 on left at 2")
+    return lines
+
+
+# Cable as it was stored before __slots__, kept as a baseline
+class LegacyCable:
+    def __init__(self, room_uid, size, start, end, vertical):
+        self.room_uid = room_uid
+        self.size = int(size)
+        self.start = start
+        self.end = end
+        self.is_vertical = vertical
+
+
+def cableArgs(count):
+    for i in range(count):
+        x = i % 9
+        yield "1", "4", [x, 0], [x, 8], True
+
+
+def memoryOf(build, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = build(count)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size, elapsed
+
+
+def statementLines(src):
+    return [line.strip() for text in src for line in text.split("\n") if line.strip()]
+
+
+def timeIt(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def benchLoops(sizes, times, depth):
+    print("loops    legacy (s)    single pass (s)    speedup")
+    for loops in sizes:
+        src = loopSource(loops, times, depth)
+        legacy, expected = timeIt(legacyExpandLoops, src)
+        numbered = list(numberLines(src))
+        current, result = timeIt(lambda lines: list(parseLoops(lines)), numbered)
+        result = [line for _, line in result]
+        # The legacy driver leaves blank lines behind, they carry no statements
+        assert statementLines(expected) == statementLines(result), "Outputs differ"
+        print(
+            "{:<8} {:<13.4f} {:<18.4f} {:.1f}x".format(
+                loops, legacy, current, legacy / current if current else 0
+            )
+        )
+
+
+def benchMacros(sizes, calls):
+    print("macros   legacy (s)    templates (s)    speedup")
+    for macros in sizes:
+        src = macroSource(macros, calls)
+        src = list(numberLines(src))
+        table = collectMacros(src)
+        # Both sides strip the definitions out of the same source
+        legacy, expected = timeIt(
+            lambda lines: legacyExpandMacros(
+                [line for _, line in splitMacros(lines, {})], table
+            ),
+            src,
+        )
+        current, result = timeIt(lambda lines: list(expandMacros(lines, table)), src)
+        result = [line for _, line in result]
+        assert statementLines(expected) == statementLines(result), "Outputs differ"
+        print(
+            "{:<8} {:<13.4f} {:<16.4f} {:.1f}x".format(
+                macros, legacy, current, legacy / current if current else 0
+            )
+        )
+
+
+def benchModel(sizes):
+    models = [
+        ("dict", lambda n: [LegacyCable(*args) for args in cableArgs(n)]),
+        ("slots", lambda n: [Cable(*args) for args in cableArgs(n)]),
+        ("array", lambda n: CableArray(Cable(*args) for args in cableArgs(n))),
+    ]
+    print("cables      model    memory (KiB)    bytes/cable    build (s)")
+    for count in sizes:
+        for name, build in models:
+            size, elapsed = memoryOf(build, count)
+            print(
+                "{:<11} {:<8} {:<15.1f} {:<14.1f} {:.4f}".format(
+                    count, name, size / 1024, size / count, elapsed
+                )
+            )
+
+
+def pipelineStages(path):
+    # Each stage feeds on the previous ones, generators are drained so their
+    # time is charged to the stage that does the work
+    state = {}
+
+    def macros():
+        state["lines"] = list(parseMacros(path))
+
+    def loops():
+        state["lines"] = list(parseLoops(state["lines"]))
+
+    def conditionals():
+        state["lines"] = list(parseConditionals(state["lines"]))
+
+    def statements():
+        state["index"] = StatementIndex(state["lines"])
+
+    def variables():
+        parseVariables(state["index"])
+        parseMath(state["index"])
+
+    def rooms():
+        state["rooms"] = parseRooms(state["index"])
+
+    def drawRooms():
+        state["images"] = [drawRoom(room) for room in state["rooms"]]
+
+    def drawFull():
+        drawFullRoom(state["rooms"], state["images"])
+
+    return [
+        ("macros", macros),
+        ("loops", loops),
+        ("conditionals", conditionals),
+        ("statements", statements),
+        ("variables", variables),
+        ("rooms", rooms),
+        ("drawRoom", drawRooms),
+        ("drawFullRoom", drawFull),
+    ]
+
+
+def measureStages(path, repeat):
+    seconds = {}
+    for _ in range(repeat):
+        for name, stage in pipelineStages(path):
+            elapsed, _ = timeIt(stage)
+            seconds[name] = min(seconds.get(name, elapsed), elapsed)
+    # Tracing slows everything down, so memory gets a run of its own. Only
+    # Python allocations are seen, not the pixel buffers PIL allocates
+    peaks = {}
+    tracemalloc.start()
+    for name, stage in pipelineStages(path):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        stage()
+        peaks[name] = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return seconds, peaks
+
+
+def benchStages(options, scales, repeat, output):
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # drawFullRoom writes full.png into the working directory
+        os.chdir(directory)
+        try:
+            for scale in scales:
+                sized = dict(options)
+                for key in ("rooms", "variables", "macros"):
+                    sized[key] = options[key] * scale
+                path = os.path.join(directory, "bench.floor")
+                with open(path, "w") as f:
+                    f.writelines(generateFloor(**sized))
+                seconds, peaks = measureStages(path, repeat)
+                for name in seconds:
+                    results.append(
+                        {
+                            "scale": scale,
+                            "options": sized,
+                            "stage": name,
+                            "seconds": seconds[name],
+                            "peak_bytes": peaks[name],
+                        }
+                    )
+        finally:
+            os.chdir(cwd)
+
+    print("stage          scale    time (s)    peak (KiB)    growth")
+    previous = {}
+    for result in results:
+        name = result["stage"]
+        # Exponent of the time against the scale, 1 is linear, 2 quadratic
+        growth = ""
+        if name in previous and previous[name]["seconds"] > 0:
+            ratio = result["seconds"] / previous[name]["seconds"]
+            steps = result["scale"] / previous[name]["scale"]
+            if ratio > 0 and steps > 1:
+                growth = "{:.2f}".format(math.log(ratio) / math.log(steps))
+        previous[name] = result
+        print(
+            "{:<14} {:<8} {:<11.4f} {:<13.1f} {}".format(
+                name,
+                result["scale"],
+                result["seconds"],
+                result["peak_bytes"] / 1024,
+                growth,
+            )
+        )
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    args = sys.argv[1:]
+    # Bare sizes keep running the loop benchmark, as they always did
+    if not args or args[0] not in ("loops", "macros", "model", "stages"):
+        args = ["loops"] + args
+    parser = argparse.ArgumentParser(description="floorplanner benchmarks")
+    commands = parser.add_subparsers(dest="bench")
+    loops = commands.add_parser("loops", help="loop expansion against the old driver")
+    loops.add_argument("sizes", type=int, nargs="*", default=[10, 50, 200])
+    macros = commands.add_parser("macros", help="macro expansion against the old one")
+    macros.add_argument("sizes", type=int, nargs="*", default=[10, 100, 1000])
+    model = commands.add_parser("model", help="memory taken by cables")
+    model.add_argument("sizes", type=int, nargs="*", default=[1000, 10000, 100000])
+    stages = commands.add_parser(
+        "stages", help="every pipeline stage on generated floors"
+    )
+    addGeneratorArguments(stages)
+    stages.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="multipliers of the room, variable and macro counts",
+    )
+    stages.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    stages.add_argument("--output", metavar="JSON", help="write the results here")
+    args = parser.parse_args(args)
+
+    if args.bench == "macros":
+        benchMacros(args.sizes, 10000)
+    elif args.bench == "model":
+        benchModel(args.sizes)
+    elif args.bench == "stages":
+        benchStages(generatorOptions(args), args.scales, args.repeat, args.output)
+    else:
+        benchLoops(args.sizes, 10, 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import random
+
+from floorplanner import Const
+
+
+def macroLines():
+    return [
+        "new macro pc params r,x,y equals",
+        "new box room @r@ name PC anchor @x@,@y@ color 0,0,255",
+        "stop macro pc",
+    ]
+
+
+def variableLines(count):
+    lines = []
+    for n in range(count):
+        if n % 2 == 0:
+            lines.append("set var name v" + str(n) + " value " + str(n % 8 + 1))
+        else:
+            # Every other variable goes through math, referring to the last one
+            lines.append("do math sum @v" + str(n - 1) + "@ by 1 into v" + str(n))
+    return lines
+
+
+def cableLine(room, rng):
+    a, b = sorted(rng.sample(range(Const.ROOM_SIZE), 2))
+    at = rng.randrange(Const.ROOM_SIZE)
+    if rng.random() < 0.5:
+        return "new cable room {} type V size {} from {},{} to {},{}".format(
+            room, rng.randint(1, 3), at, a, at, b
+        )
+    return "new cable room {} type H size {} from {},{} to {},{}".format(
+        room, rng.randint(1, 3), a, at, b, at
+    )
+
+
+def loopLines(room, depth):
+    # Nested loops of two rounds each, the innermost one draws a cable using
+    # every index, so a block expands into 2 ** depth cables
+    lines = []
+    for d in range(depth):
+        lines.append("new loop times 2 index l" + str(d) + " equals")
+    lines.append(
+        "new cable room {} type H size 1 from 0,@l{}@ to 8,@l{}@".format(
+            room, depth - 1, depth - 1
+        )
+    )
+    for d in range(depth):
+        lines.append("stop loop")
+    return lines
+
+
+def conditionalLines(room, depth, rng):
+    lines = []
+    for d in range(depth):
+        lines.append("new if greater {} than {} equals".format(d + 2, d + 1))
+    lines.append(
+        "new box room {} name IF anchor {},{}".format(
+            room, rng.randrange(Const.ROOM_SIZE), rng.randrange(Const.ROOM_SIZE)
+        )
+    )
+    for d in range(depth):
+        lines.append("else")
+        lines.append("new box room {} name ELSE anchor 0,0".format(room))
+        lines.append("stop if")
+    return lines
+
+
+def generateFloor(
+    rooms=10,
+    boxes=4,
+    cables=8,
+    doors=2,
+    variables=10,
+    macros=10,
+    loop_depth=2,
+    if_depth=2,
+    seed=0,
+):
+    rng = random.Random(seed)
+    lines = macroLines() + variableLines(variables)
+    columns = max(1, math.ceil(math.sqrt(rooms)))
+    for room in range(1, rooms + 1):
+        # v0 is always 1, half the rooms read their width from it
+        size = "@v0@" if variables and room % 2 else "1"
+        lines.append(
+            "new room id {} width {} height 1 anchor {},{}".format(
+                room, size, 2 * ((room - 1) % columns), (room - 1) // columns
+            )
+        )
+        for n in range(boxes):
+            lines.append(
+                "new box room {} name B{} anchor {},{} color 120,120,120".format(
+                    room,
+                    n,
+                    rng.randrange(Const.ROOM_SIZE),
+                    rng.randrange(Const.ROOM_SIZE),
+                )
+            )
+        for n in range(cables):
+            lines.append(cableLine(room, rng))
+        for n in range(doors):
+            lines.append(
+                "new door room {} on {} at {}".format(
+                    room,
+                    rng.choice(["left", "right", "top", "bottom"]),
+                    rng.randint(1, Const.ROOM_SIZE - 1),
+                )
+            )
+        if loop_depth:
+            lines.extend(loopLines(room, loop_depth))
+        if if_depth:
+            lines.extend(conditionalLines(room, if_depth, rng))
+    # Macro calls are spread over the rooms
+    for n in range(macros):
+        lines.append(
+            "pc r {} x {} y {}".format(
+                n % rooms + 1,
+                rng.randrange(Const.ROOM_SIZE),
+                rng.randrange(Const.ROOM_SIZE),
+            )
+        )
+    return [line + "\n" for line in lines]
+
+
+def addGeneratorArguments(parser):
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--boxes", type=int, default=4, help="per room")
+    parser.add_argument("--cables", type=int, default=8, help="per room")
+    parser.add_argument("--doors", type=int, default=2, help="per room")
+    parser.add_argument("--variables", type=int, default=10)
+    parser.add_argument("--macros", type=int, default=10, help="macro calls")
+    parser.add_argument("--loop-depth", type=int, default=2)
+    parser.add_argument("--if-depth", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generatorOptions(args):
+    return {
+        "rooms": args.rooms,
+        "boxes": args.boxes,
+        "cables": args.cables,
+        "doors": args.doors,
+        "variables": args.variables,
+        "macros": args.macros,
+        "loop_depth": args.loop_depth,
+        "if_depth": args.if_depth,
+        "seed": args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic .floor plan")
+    parser.add_argument("output", help="floor file to write")
+    addGeneratorArguments(parser)
+    args = parser.parse_args()
+    with open(args.output, "w") as f:
+        f.writelines(generateFloor(**generatorOptions(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,52 @@
 #!/usr/bin/env python3
-import sys
-from PIL import Image, ImageDraw
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import hashlib
+import heapq
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import tracemalloc
+import xml.sax.saxutils
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class LazyModule:
+    # Imported on first use, so --check never pays for PIL
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
 
 
 class Const:
@@ -15,38 +61,172 @@ class Const:
     ROOM_SIZE = 9
 
 
+class StageTimer:
+    def __init__(self):
+        self.times = {}
+        # Filled only while profiling, hot paths check the flag first
+        self.profiling = False
+        self.peaks = {}
+        self.counters = {}
+        # Floors may be rendered from several threads, each with its own
+        # stage nesting
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def profile(self):
+        self.profiling = True
+        tracemalloc.start()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Memory is only followed for top level stages, a nested one would
+        # reset the peak of the stage around it
+        depth = getattr(self.local, "depth", 0)
+        memory = self.profiling and not depth
+        if memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        self.local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.local.depth = depth
+            with self.lock:
+                self.times[name] = self.times.get(name, 0) + elapsed
+                if memory:
+                    peak = tracemalloc.get_traced_memory()[1] - base
+                    self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+    def report(self):
+        return "\n".join(
+            "{:<16} {:.4f}s".format(name, seconds)
+            for name, seconds in self.times.items()
+        )
+
+    def profileData(self):
+        data = {
+            "stages": [
+                {"stage": name, "seconds": seconds, "peak_bytes": self.peaks.get(name)}
+                for name, seconds in self.times.items()
+            ],
+            "counters": dict(sorted(self.counters.items())),
+        }
+        if resource is not None:
+            # Kilobytes on Linux, includes the pixel buffers tracemalloc misses
+            data["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return data
+
+    def profileReport(self):
+        data = self.profileData()
+        lines = ["stage            time (s)    peak (KiB)"]
+        for stage in data["stages"]:
+            peak = stage["peak_bytes"]
+            lines.append(
+                "{:<16} {:<11.4f} {}".format(
+                    stage["stage"],
+                    stage["seconds"],
+                    "-" if peak is None else "{:.1f}".format(peak / 1024),
+                )
+            )
+        lines.append("")
+        for name, value in data["counters"].items():
+            lines.append("{:<20} {}".format(name, value))
+        if "max_rss_kb" in data:
+            lines.append("{:<20} {}".format("max rss (KiB)", data["max_rss_kb"]))
+        return "\n".join(lines)
+
+
+# Stage timings of this process, printed with --timings
+TIMER = StageTimer()
+
+
+class Render:
+    # Drawing settings, handed over to the --jobs worker processes as well
+    numpy = False
+    numpy_strands = 256
+    # Level of detail: smallest cells that still get a grid, box labels and
+    # separate strands
+    lod_grid = 8
+    lod_labels = 24
+    lod_strands = 16
+
+
+def scaledCellSize(scale):
+    # Pixels per cell at a fraction of the full size, whole and at least one
+    assert scale > 0, "Scale must be positive"
+    return max(1, round(Const.CELL_SIZE * scale))
+
+
+def strandGap(cell_size):
+    # Strands are 4 pixels apart at full size
+    return cell_size // 8
+
+
+def lineWidth(width, cell_size):
+    # Stroke widths are given at full size and shrink with the cells
+    return max(1, width * cell_size // Const.CELL_SIZE)
+
+
+def renderSettings():
+    return {k: v for k, v in vars(Render).items() if not k.startswith("_")}
+
+
+def configureRender(settings):
+    for k, v in settings.items():
+        setattr(Render, k, v)
+
+
 class Variable:
-    def __init__(self, name, value, linen):
+    __slots__ = ("name", "value", "order")
+
+    def __init__(self, name, value, order):
         self.name = name
         self.value = value
-        self.linen = linen
+        self.order = order
 
 
 class Cable:
-    def __init__(self, room_uid, size, start, end, vertical):
+    __slots__ = ("room_uid", "size", "start", "end", "is_vertical", "linen")
+
+    def __init__(self, room_uid, size, start, end, vertical, linen=None):
         self.room_uid = room_uid
         self.size = int(size)
         self.start = start
         self.end = end
         self.is_vertical = vertical
+        self.linen = linen
 
 
 class Box:
-    def __init__(self, room_uid, name, anchor, color):
+    __slots__ = ("room_uid", "name", "anchor", "color", "linen")
+
+    def __init__(self, room_uid, name, anchor, color, linen=None):
         self.room_uid = room_uid
         self.name = name
         self.anchor = anchor
         self.color = color
+        self.linen = linen
 
 
 class Door:
-    def __init__(self, room_uid, on, at):
+    __slots__ = ("room_uid", "on", "at", "linen")
+
+    def __init__(self, room_uid, on, at, linen=None):
         self.room_uid = room_uid
         self.on = on
         self.at = int(at)
+        self.linen = linen
 
 
 class Room:
+    __slots__ = ("uid", "width", "height", "anchor", "boxes", "cables", "doors")
+
     def __init__(
         self,
         uid,
@@ -66,14 +246,177 @@ class Room:
         self.doors = doors if doors else []
 
 
-def parseMacros(src):
+class CableView:
+    # Reads like a Cable, backed by one row of a CableArray
+    __slots__ = ("cables", "i")
+
+    def __init__(self, cables, i):
+        self.cables = cables
+        self.i = i
+
+    @property
+    def room_uid(self):
+        return self.cables.room_uid
+
+    @property
+    def size(self):
+        return self.cables.size[self.i]
+
+    @property
+    def start(self):
+        return [self.cables.start_x[self.i], self.cables.start_y[self.i]]
+
+    @property
+    def end(self):
+        return [self.cables.end_x[self.i], self.cables.end_y[self.i]]
+
+    @property
+    def is_vertical(self):
+        return bool(self.cables.vertical[self.i])
+
+    @property
+    def linen(self):
+        linen = self.cables.linen[self.i]
+        return None if linen < 0 else linen
+
+
+class CableArray:
+    # Columnar storage for the cables of one room, a few bytes per cable
+    __slots__ = (
+        "room_uid",
+        "size",
+        "start_x",
+        "start_y",
+        "end_x",
+        "end_y",
+        "vertical",
+        "linen",
+    )
+
+    def __init__(self, cables=()):
+        self.room_uid = None
+        self.size = array.array("i")
+        self.start_x = array.array("i")
+        self.start_y = array.array("i")
+        self.end_x = array.array("i")
+        self.end_y = array.array("i")
+        self.vertical = array.array("b")
+        # -1 stands for a cable without a source line
+        self.linen = array.array("i")
+        for cable in cables:
+            self.append(cable)
+
+    def append(self, cable):
+        self.room_uid = cable.room_uid
+        self.size.append(cable.size)
+        self.start_x.append(cable.start[0])
+        self.start_y.append(cable.start[1])
+        self.end_x.append(cable.end[0])
+        self.end_y.append(cable.end[1])
+        self.vertical.append(cable.is_vertical)
+        self.linen.append(-1 if cable.linen is None else cable.linen)
+
+    def __len__(self):
+        return len(self.size)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("cable index out of range")
+        return CableView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield CableView(self, i)
+
+
+class BoxView:
+    # Reads like a Box, backed by one row of a BoxArray
+    __slots__ = ("boxes", "i")
+
+    def __init__(self, boxes, i):
+        self.boxes = boxes
+        self.i = i
+
+    @property
+    def room_uid(self):
+        return self.boxes.room_uid
+
+    @property
+    def name(self):
+        return self.boxes.name[self.i]
+
+    @property
+    def anchor(self):
+        return [self.boxes.anchor_x[self.i], self.boxes.anchor_y[self.i]]
+
+    @property
+    def color(self):
+        return list(self.boxes.color[3 * self.i : 3 * self.i + 3])
+
+    @property
+    def linen(self):
+        linen = self.boxes.linen[self.i]
+        return None if linen < 0 else linen
+
+
+class BoxArray:
+    # Columnar storage for the boxes of one room
+    __slots__ = ("room_uid", "name", "anchor_x", "anchor_y", "color", "linen")
+
+    def __init__(self, boxes=()):
+        self.room_uid = None
+        self.name = []
+        self.anchor_x = array.array("i")
+        self.anchor_y = array.array("i")
+        # Three entries per box, red, green and blue
+        self.color = array.array("i")
+        self.linen = array.array("i")
+        for box in boxes:
+            self.append(box)
+
+    def append(self, box):
+        self.room_uid = box.room_uid
+        self.name.append(box.name)
+        self.anchor_x.append(box.anchor[0])
+        self.anchor_y.append(box.anchor[1])
+        self.color.extend(box.color[:3])
+        self.linen.append(-1 if box.linen is None else box.linen)
+
+    def __len__(self):
+        return len(self.name)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("box index out of range")
+        return BoxView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield BoxView(self, i)
+
+
+def readSource(src):
+    if TIMER.profiling:
+        TIMER.count("files opened")
     with open(src, "r") as f:
-        lines = [line.strip() for line in f.readlines() if line]
+        for line in f:
+            yield line.strip()
 
-    macroless_src = []
-    macros = {}
+
+def numberLines(lines):
+    # Every stage passes (line number in the file, text) pairs along, so
+    # problems are reported on the line the user wrote
+    return enumerate(lines)
+
+
+def splitMacros(lines, macros):
+    # Collects macro definitions into macros and yields every other line
     current_macro = None
-    for line in lines:
+    for linen, line in lines:
         if line.startswith("new macro"):
             if not "equals" in line:
                 assert False, "Invalid macro syntax"
@@ -99,327 +442,579 @@ def parseMacros(src):
             current_macro = ""
             continue
         if not current_macro:
-            macroless_src.append(line)
+            yield linen, line
         else:
             macros[current_macro]["lines"].append(line)
 
-    macroed_src = []
-    for line in macroless_src:
-        for k, v in macros.items():
-            if line.startswith(k):
-                keywords = line.split(" ")[1::2]
-                values = line.split(" ")[2::2]
-                zipped = {k: v for k, v in zip(keywords, values)}
-                line = "\n".join(v["lines"])
-                for p in v["params"]:
-                    line = line.replace("@" + p + "@", zipped[p])
-        macroed_src.append(line + "\n")
 
-    return macroed_src
+def compileMacro(macro):
+    # Every body line is split once into literal text at even positions and
+    # parameter names at odd ones
+    if not macro["params"]:
+        return [[line] for line in macro["lines"]]
+    names = "|".join(re.escape(p) for p in macro["params"])
+    pattern = re.compile("@(" + names + ")@")
+    return [pattern.split(line) for line in macro["lines"]]
 
 
-def parseLoops(lines):
-    looped_src = []
-    current_index = None
-    current_times = 0
-    done = False
-    met_loops = 0
-    i = 0
-    while not done:
-        if i >= len(lines):
-            done = True
-            continue
-        line = lines[i]
-        if current_index:
-            l = 1
-            for j in range(current_times):
-                l = 1
-                met_loops = 1
-                while True:
-                    loop_line = lines[i + l]
-                    if loop_line.startswith("new loop"):
-                        met_loops += 1
-                    if loop_line.startswith("stop loop"):
-                        met_loops -= 1
-                    if loop_line.startswith("stop loop") and met_loops <= 1:
-                        looped_src.append(loop_line)
-                        break
-                    replaced = (
-                        loop_line.replace("@" + current_index + "@", str(j)) + "\n"
-                    )
-                    looped_src.append(replaced)
-                    l += 1
-            for k in range(i + l + 1, len(lines)):
-                looped_src.append(lines[k])
-            break
-        if line.startswith("new loop"):
-            if not all([keyword in line for keyword in ["times", "index", "equals"]]):
-                assert False, "Invalid loop syntax"
-            met_loops = 1
-            keywords = line.split(" ")[2::2]
-            values = line.split(" ")[3::2]
-            zipped = {k: v for k, v in zip(keywords, values)}
-            if int(zipped["times"]) < 0:
-                assert False, "Loop cannot run less than 0 times"
-            current_index = zipped["index"]
-            current_times = int(zipped["times"])
-        elif line.startswith("stop loop"):
-            current_index = None
-            i += 1
-        else:
-            looped_src.append(line)
-            i += 1
-
-    return looped_src
-
-
-def parseConditionals(lines):
-    i = 0
-    done = False
-    keep_if = False
-    inside_if = False
-    inside_else = False
-    conditioned_src = []
-    met_conditionals = 0
-    while not done:
-        if i >= len(lines):
-            done = True
-            continue
-        line = lines[i]
-        if inside_if:
-            if keep_if:
-                l = 1
-                while True:
-                    if lines[i + l].startswith("new if"):
-                        met_conditionals += 1
-                    if lines[i + l].startswith("stop if"):
-                        met_conditionals -= 1
-                    if (
-                        any(
-                            [
-                                lines[i + l].startswith(cond)
-                                for cond in ["else", "stop if"]
-                            ]
-                        )
-                        and met_conditionals <= 1
-                    ):
-                        break
-                    conditioned_src.append(lines[i + l])
-                    l += 1
-                l += 1
-                while True:
-                    if lines[i + l].startswith("new if"):
-                        met_conditionals += 1
-                    if lines[i + l].startswith("stop if"):
-                        met_conditionals -= 1
-                    if lines[i + l].startswith("stop if") and met_conditionals <= 1:
-                        break
-                    l += 1
-                for k in range(i + l + 1, len(lines)):
-                    conditioned_src.append(lines[k])
-            else:
-                l = 1
-                while True:
-                    if lines[i + l].startswith("new if"):
-                        met_conditionals += 1
-                    if lines[i + l].startswith("stop if"):
-                        met_conditionals -= 1
-                    if (
-                        any(
-                            [
-                                lines[i + l].startswith(cond)
-                                for cond in ["else", "stop if"]
-                            ]
-                        )
-                        and met_conditionals <= 1
-                    ):
-                        break
-                    l += 1
-                l += 1
-                while True:
-                    if lines[i + l].startswith("new if"):
-                        met_conditionals += 1
-                    if lines[i + l].startswith("stop if"):
-                        met_conditionals -= 1
-                    if lines[i + l].startswith("stop if") and met_conditionals <= 1:
-                        break
-                    conditioned_src.append(lines[i + l])
-                    l += 1
-                for k in range(i + l + 1, len(lines)):
-                    conditioned_src.append(lines[k])
-            break
-        if line.startswith("new if"):
-            if not any(
-                [
-                    keyword in line
-                    for keyword in [
-                        "equals",
-                    ]
-                ]
-            ):
-                assert False, "Invalid conditional syntax"
-            met_conditionals = 1
-            keywords = line.split(" ")[2::2]
-            values = line.split(" ")[3::2]
-            zipped = {k: v for k, v in zip(keywords, values)}
-            inside_if = True
-            inside_else = False
-            if "greater" in zipped:
-                if int(zipped["greater"]) > int(zipped["than"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "greater-equal" in zipped:
-                if int(zipped["greater-equal"]) >= int(zipped["than"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "lesser" in zipped:
-                if int(zipped["lesser"]) < int(zipped["than"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "lesser-equal" in zipped:
-                if int(zipped["lesser-equal"]) <= int(zipped["than"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "same" in zipped:
-                if int(zipped["same"]) == int(zipped["and"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "different" in zipped:
-                if int(zipped["different"]) != int(zipped["and"]):
-                    keep_if = True
-                else:
-                    keep_if = False
-            elif "multiple" in zipped:
-                if int(zipped["multiple"]) % int(zipped["of"]) == 0:
-                    keep_if = True
-                else:
-                    keep_if = False
-            else:
-                assert False, "Unknown condition"
-        else:
-            conditioned_src.append(line)
-            i += 1
-
-    return conditioned_src
+def collectMacros(lines):
+    macros = {}
+    for _ in splitMacros(lines, macros):
+        pass
+    for macro in macros.values():
+        macro["template"] = compileMacro(macro)
+    return macros
 
 
-def handleVariables(value, linen):
-    global variables
+def parseMacros(src):
+    # Macros can be called before they are defined, so the definitions are
+    # read in a first pass and the source is streamed in a second one
+    return expandMacros(
+        numberLines(readSource(src)), collectMacros(numberLines(readSource(src)))
+    )
 
-    to_skip = []
-    for variable in variables:
-        for secondVar in variables:
-            if (
-                secondVar.name == variable.name
-                and secondVar.linen > variable.linen
-                and linen >= secondVar.linen
-            ):
-                to_skip.append(variable)
 
-    for variable in variables:
-        if variable in to_skip:
+def callMacro(line, macros, calling):
+    # Calls are recognised by their first word, so "pc" never matches "pcs"
+    name = line.split(" ", 1)[0]
+    if name not in macros:
+        yield line
+        return
+    if name in calling:
+        assert False, 'Macro "' + name + '" calls itself: "' + line + '"'
+    macro = macros[name]
+    keywords = line.split(" ")[1::2]
+    values = line.split(" ")[2::2]
+    zipped = {k: v for k, v in zip(keywords, values)}
+    for p in macro["params"]:
+        if p not in zipped:
+            assert False, 'Missing macro parameter "' + p + '": "' + line + '"'
+    calling.append(name)
+    for parts in macro["template"]:
+        parts = list(parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = zipped[parts[i]]
+        # A body line may call another macro
+        yield from callMacro("".join(parts), macros, calling)
+    calling.pop()
+
+
+def expandMacros(lines, macros):
+    for linen, line in splitMacros(lines, {}):
+        if line.split(" ", 1)[0] not in macros:
+            yield linen, line
             continue
-        if value.strip() == "@" + variable.name + "@":
-            return variable.value
+        # Keep one source line per element so later stages can match blocks,
+        # every line of the body is reported on the line of the call
+        for expanded in callMacro(line, macros, []):
+            yield linen, expanded
 
-    return value
 
+def matchBlocks(lines, start, stop):
+    # Pairs every opening line with its closing line in a single scan
+    matches = {}
+    opened = []
+    for i, (_, line) in enumerate(lines):
+        if line.startswith(start):
+            opened.append(i)
+        elif line.startswith(stop) and opened:
+            matches[opened.pop()] = i
+    if opened:
+        assert False, 'Unterminated block: "' + lines[opened[-1]][1].strip() + '"'
+    return matches
+
+
+def parseLoopHeader(line):
+    if not all([keyword in line for keyword in ["times", "index", "equals"]]):
+        assert False, "Invalid loop syntax"
+    keywords = line.split(" ")[2::2]
+    values = line.split(" ")[3::2]
+    zipped = {k: v for k, v in zip(keywords, values)}
+    if int(zipped["times"]) < 0:
+        assert False, "Loop cannot run less than 0 times"
+    return "@" + zipped["index"] + "@", int(zipped["times"])
+
+
+def expandLoops(lines):
+    matches = matchBlocks(lines, "new loop", "stop loop")
+
+    def expand(begin, end, indexes):
+        i = begin
+        while i < end:
+            linen, line = lines[i]
+            # Outer indexes are substituted first, as they were expanded first
+            for index, value in indexes:
+                line = line.replace(index, value)
+            if line.startswith("new loop"):
+                index, times = parseLoopHeader(line.strip())
+                for j in range(times):
+                    yield from expand(i + 1, matches[i], indexes + [(index, str(j))])
+                i = matches[i] + 1
+                continue
+            if not line.startswith("stop loop"):
+                yield linen, line
+            i += 1
 
-def setVariables(varrs):
-    global variables
-    variables = varrs
+    yield from expand(0, len(lines), [])
 
 
-def parseRooms(src):
-    global variables
+def parseLoops(lines):
+    # Only the source of the current top level loop is buffered, never its
+    # expansion
+    block = []
+    depth = 0
+    for item in lines:
+        line = item[1]
+        if line.startswith("new loop"):
+            depth += 1
+        elif line.startswith("stop loop"):
+            if not depth:
+                continue
+            depth -= 1
+            if not depth:
+                block.append(item)
+                if TIMER.profiling:
+                    TIMER.count("loops expanded")
+                yield from expandLoops(block)
+                block = []
+                continue
+        if depth:
+            block.append(item)
+        else:
+            yield item
+    if block:
+        yield from expandLoops(block)
+
+
+CONDITIONS = {
+    "greater": ("than", lambda a, b: a > b),
+    "greater-equal": ("than", lambda a, b: a >= b),
+    "lesser": ("than", lambda a, b: a < b),
+    "lesser-equal": ("than", lambda a, b: a <= b),
+    "same": ("and", lambda a, b: a == b),
+    "different": ("and", lambda a, b: a != b),
+    "multiple": ("of", lambda a, b: a % b == 0),
+}
+
+
+def evaluateConditional(line):
+    if not "equals" in line:
+        assert False, "Invalid conditional syntax"
+    keywords = line.split(" ")[2::2]
+    values = line.split(" ")[3::2]
+    zipped = {k: v for k, v in zip(keywords, values)}
+    for condition, (other, compare) in CONDITIONS.items():
+        if condition in zipped:
+            return compare(int(zipped[condition]), int(zipped[other]))
+    assert False, "Unknown condition"
 
-    with open(src, "r") as f:
-        lines = [line.strip() for line in f.readlines() if line]
 
-    h = lambda v, l: handleVariables(v, l)
-    ROOMS = []
-    for i, line in enumerate(lines):
-        if line.startswith("new room"):
-            if not all(
-                [keyword in line for keyword in ["id", "width", "height", "anchor"]]
-            ):
-                assert False, 'Invalid room creation syntax: "' + line + '"'
+def parseConditionals(lines):
+    # One frame per open "new if": whether the enclosing block is kept,
+    # whether the condition held and whether its else was met
+    frames = []
+    keeping = True
+    for linen, line in lines:
+        if line.startswith("new if"):
+            taken = keeping and evaluateConditional(line.strip())
+            frames.append([keeping, taken, False])
+            keeping = taken
+            continue
+        if frames and line.startswith("else"):
+            if frames[-1][2]:
+                assert False, "Conditional has more than one else"
+            frames[-1][2] = True
+            keeping = frames[-1][0] and not frames[-1][1]
+            continue
+        if frames and line.startswith("stop if"):
+            keeping = frames.pop()[0]
+            continue
+        if keeping:
+            yield linen, line
+    if frames:
+        assert False, "Unterminated conditional"
+
+
+class VariableTable:
+    def __init__(self):
+        # name -> (sorted positions of the definitions in the expanded source,
+        # values in the same order)
+        self.definitions = {}
+        self.count = 0
+        self.lookups = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, variable):
+        self.count += 1
+        orders, values = self.definitions.setdefault(variable.name, ([], []))
+        if not orders or variable.order >= orders[-1]:
+            orders.append(variable.order)
+            values.append(variable.value)
+        else:
+            at = bisect.bisect_right(orders, variable.order)
+            orders.insert(at, variable.order)
+            values.insert(at, variable.value)
+
+    def lookup(self, name, order):
+        self.lookups += 1
+        if name not in self.definitions:
+            return None
+        orders, values = self.definitions[name]
+        # The latest definition at or before the line wins, references that
+        # precede every definition fall back to the first one
+        at = bisect.bisect_right(orders, order)
+        return values[at - 1] if at else values[0]
+
+
+def handleVariables(value, order, variables):
+    name = value.strip()
+    if len(name) < 3 or name[0] != "@" or name[-1] != "@":
+        return value
+    found = variables.lookup(name[1:-1], order)
+    return value if found is None else found
+
+
+STATEMENT_KINDS = {
+    "new room": "room",
+    "new box": "box",
+    "new cable": "cable",
+    "new door": "door",
+    "set var": "var",
+    "do math": "math",
+    "route cable": "route",
+}
+
+
+class Statement:
+    # order is the position in the expanded source, which decides the value
+    # of a variable, linen the line of the file the statement came from
+    __slots__ = ("kind", "order", "linen", "line", "zipped")
+
+    def __init__(self, kind, order, linen, line, zipped):
+        self.kind = kind
+        self.order = order
+        self.linen = linen
+        self.line = line
+        self.zipped = zipped
+
+
+class StatementIndex:
+    def __init__(self, lines):
+        self.statements = {kind: [] for kind in STATEMENT_KINDS.values()}
+        self.by_room = {}
+        self.variables = VariableTable()
+        # A list collects bad statements instead of stopping at the first
+        self.problems = None
+        i = -1
+        for i, (linen, line) in enumerate(lines):
+            line = line.strip()
+            kind = STATEMENT_KINDS.get(" ".join(line.split(" ", 2)[:2]))
+            if kind is None:
+                continue
             keywords = line.split(" ")[2::2]
             values = line.split(" ")[3::2]
-            zipped = {k: h(v, i) for k, v in zip(keywords, values)}
-            BOXES = parseBoxesForRoom(src, zipped["id"])
-            CABLES = parseCablesForRoom(src, zipped["id"])
-            DOORS = parseDoorsForRoom(src, zipped["id"])
-            ROOMS.append(
-                Room(
-                    zipped["id"],
-                    zipped["width"],
-                    zipped["height"],
-                    [int(h(n, i)) for n in h(zipped["anchor"], i).split(",")],
-                    BOXES,
-                    CABLES,
-                    DOORS,
+            zipped = {k: v for k, v in zip(keywords, values)}
+            self.statements[kind].append(Statement(kind, i, linen, line, zipped))
+        if TIMER.profiling:
+            TIMER.count("lines scanned", i + 1)
+
+    def of(self, kind):
+        return self.statements[kind]
+
+    def grouped(self, kind):
+        # Grouping needs resolved room ids, so it is built on first use,
+        # after the variables have been parsed
+        if kind not in self.by_room:
+            grouped = {}
+            for statement in self.statements[kind]:
+                uid = statement.zipped.get("room")
+                if uid is not None:
+                    try:
+                        uid = str(handleVariables(uid, statement.order, self.variables))
+                    except STATEMENT_ERRORS as e:
+                        if self.problems is None:
+                            raise
+                        noteProblem(self.problems, statement, e)
+                        continue
+                grouped.setdefault(uid, []).append(statement)
+            self.by_room[kind] = grouped
+        return self.by_room[kind]
+
+    def forRoom(self, kind, room):
+        return self.grouped(kind).get(str(room), [])
+
+
+# Unit steps right, down, left and up, as (x, y)
+DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+
+class Router:
+    # Obstacles of one room plus one distance field per target box, so every
+    # route to an already seen box is a walk down its field
+    def __init__(self, rows, columns, boxes, doors):
+        self.rows = rows
+        self.columns = columns
+        self.blocked = bytearray(rows * columns)
+        self.boxes = {}
+        for box in boxes:
+            x, y = box.anchor[0], box.anchor[1]
+            self.boxes.setdefault(box.name, (x, y))
+            if self.inside(x, y):
+                self.blocked[y * columns + x] = 1
+        for door in doors:
+            for y, x in doorCells(door, rows, columns):
+                if self.inside(x, y):
+                    self.blocked[y * columns + x] = 1
+        # A step costs more than any number of turns, so paths are shortest
+        # first and have the fewest bends among the shortest
+        self.step = rows * columns + 1
+        self.fields = {}
+
+    def inside(self, x, y):
+        return 0 <= x < self.columns and 0 <= y < self.rows
+
+    def field(self, target):
+        # Cost to reach target from every (cell, direction it was entered
+        # moving in), found by searching backwards from the target
+        if target in self.fields:
+            return self.fields[target]
+        columns = self.columns
+        cost = [None] * (self.rows * columns * 4)
+        tx, ty = target
+        queue = []
+        for d in range(4):
+            cost[(ty * columns + tx) * 4 + d] = 0
+            queue.append((0, tx, ty, d))
+        heapq.heapify(queue)
+        while queue:
+            c, x, y, d = heapq.heappop(queue)
+            if c != cost[(y * columns + x) * 4 + d]:
+                continue
+            # (x, y) was entered moving in d, so it was left from px, py
+            px, py = x - DIRECTIONS[d][0], y - DIRECTIONS[d][1]
+            if not self.inside(px, py) or self.blocked[py * columns + px]:
+                continue
+            for pd in range(4):
+                pc = c + self.step + (pd != d)
+                at = (py * columns + px) * 4 + pd
+                if cost[at] is None or pc < cost[at]:
+                    cost[at] = pc
+                    heapq.heappush(queue, (pc, px, py, pd))
+        self.fields[target] = cost
+        return cost
+
+    def next(self, cost, x, y, d):
+        # Cheapest step out of (x, y) having arrived moving in d, None at start
+        best = None
+        for nd, (dx, dy) in enumerate(DIRECTIONS):
+            nx, ny = x + dx, y + dy
+            if not self.inside(nx, ny):
+                continue
+            c = cost[(ny * self.columns + nx) * 4 + nd]
+            if c is None:
+                continue
+            c += self.step + (d is not None and nd != d)
+            if best is None or c < best[0]:
+                best = (c, nd, nx, ny)
+        return best
+
+    def route(self, source, target):
+        # Cells from the source box to the target box, bends included
+        cost = self.field(self.boxes[target])
+        x, y = self.boxes[source]
+        end = self.boxes[target]
+        path = [(x, y)]
+        d = None
+        left = None
+        while (x, y) != end:
+            best = self.next(cost, x, y, d)
+            if best is None:
+                return None
+            _, d, x, y = best
+            # Every step has to get closer, so a broken field cannot loop
+            at = cost[(y * self.columns + x) * 4 + d]
+            if left is not None and at >= left:
+                return None
+            left = at
+            path.append((x, y))
+        return path
+
+
+def routeSegments(path):
+    # Straight runs of a path, split where it turns
+    corners = [path[0]]
+    for before, at, after in zip(path, path[1:], path[2:]):
+        if (at[0] - before[0], at[1] - before[1]) != (
+            after[0] - at[0],
+            after[1] - at[1],
+        ):
+            corners.append(at)
+    corners.append(path[-1])
+    return list(zip(corners, corners[1:]))
+
+
+# What a malformed statement can raise while it is parsed, from a missing
+# keyword to a division by zero or a number used as a coordinate pair
+STATEMENT_ERRORS = (
+    AssertionError,
+    ValueError,
+    KeyError,
+    IndexError,
+    ZeroDivisionError,
+    AttributeError,
+    TypeError,
+)
+
+# Keywords every statement placed in a room must have
+ROOM_OBJECT_KEYWORDS = {
+    "box": ["room", "name", "anchor"],
+    "door": ["room", "on", "at"],
+    "cable": ["room", "type", "size", "from", "to"],
+    "route": ["room", "from", "to", "size"],
+}
+
+
+def noteProblem(problems, statement, error):
+    # Assertions carry their own message, anything else gets the line
+    if isinstance(error, AssertionError):
+        message = str(error)
+    else:
+        message = '{}: "{}"'.format(error, statement.line)
+    problems.append((statement.linen, message))
+
+
+def parseRoom(index, statement, compact):
+    h = lambda v, l: handleVariables(v, l, index.variables)
+    line = statement.line
+    i = statement.order
+    if not all([keyword in line for keyword in ["id", "width", "height", "anchor"]]):
+        assert False, 'Invalid room creation syntax: "' + line + '"'
+    zipped = {k: h(v, i) for k, v in statement.zipped.items()}
+    BOXES = parseBoxesForRoom(index, zipped["id"])
+    CABLES = parseCablesForRoom(index, zipped["id"])
+    DOORS = parseDoorsForRoom(index, zipped["id"])
+    CABLES += parseRoutesForRoom(
+        index, zipped["id"], zipped["width"], zipped["height"], BOXES, DOORS
+    )
+    if compact:
+        # Only one room worth of objects is alive before being packed
+        BOXES = BoxArray(BOXES)
+        CABLES = CableArray(CABLES)
+    return Room(
+        zipped["id"],
+        zipped["width"],
+        zipped["height"],
+        [int(h(n, i)) for n in h(zipped["anchor"], i).split(",")],
+        BOXES,
+        CABLES,
+        DOORS,
+    )
+
+
+def checkUnplaced(index, rooms):
+    # Statements of rooms that were not parsed are never reached room by
+    # room, they still need a room id and their keywords
+    placed = set(str(room.uid) for room in rooms)
+    for kind, required in ROOM_OBJECT_KEYWORDS.items():
+        for uid, statements in index.grouped(kind).items():
+            if uid in placed:
+                continue
+            for statement in statements:
+                if uid is not None and all(
+                    [keyword in statement.line for keyword in required]
+                ):
+                    continue
+                error = AssertionError(
+                    'Invalid creation syntax: "' + statement.line + '"'
                 )
-            )
+                if index.problems is None:
+                    raise error
+                noteProblem(index.problems, statement, error)
 
-    return ROOMS
 
+def parseRooms(index, compact=False):
+    ROOMS = []
+    for statement in index.of("room"):
+        try:
+            ROOMS.append(parseRoom(index, statement, compact))
+        except STATEMENT_ERRORS as e:
+            if index.problems is None:
+                raise
+            noteProblem(index.problems, statement, e)
+    checkUnplaced(index, ROOMS)
 
-def parseAny(src, start, required, lambda_checks, lambda_generate, addLine=False):
-    global variables
+    return ROOMS
 
-    with open(src, "r") as f:
-        lines = [line.strip() for line in f.readlines() if line]
 
+def parseStatement(
+    statement, required, lambda_checks, lambda_generate, addLine, variables
+):
+    line = statement.line
+    i = statement.order
+    if not all([keyword in line for keyword in required]):
+        assert False, 'Invalid creation syntax: "' + line + '"'
+    zipped = {
+        k: handleVariables(v, i, variables) if variables else v
+        for k, v in statement.zipped.items()
+    }
+    for check in lambda_checks:
+        assert check(zipped), (
+            'Check failed: "' + check.__name__ + '" with values "' + str(zipped) + '"'
+        )
+    if not addLine:
+        return lambda_generate(zipped)
+    return lambda_generate(zipped, statement)
+
+
+def parseAny(
+    statements,
+    required,
+    lambda_checks,
+    lambda_generate,
+    addLine=False,
+    variables=None,
+    problems=None,
+):
     OBJS = []
-    for i, line in enumerate(lines):
-        if line.startswith(start):
-            if not all([keyword in line for keyword in required]):
-                assert False, 'Invalid creation syntax: "' + line + '"'
-            keywords = line.split(" ")[2::2]
-            values = line.split(" ")[3::2]
-            zipped = {
-                k: handleVariables(v, i) if variables else v
-                for k, v in zip(keywords, values)
-            }
-            if lambda_checks and lambda_checks[-1].__name__ == "same_room":
-                if not lambda_checks[-1](zipped):
-                    continue
-            for check in lambda_checks[:-1]:
-                assert check(zipped), (
-                    'Check failed: "'
-                    + check.__name__
-                    + '" with values "'
-                    + str(zipped)
-                    + '"'
+    for statement in statements:
+        try:
+            OBJS.append(
+                parseStatement(
+                    statement,
+                    required,
+                    lambda_checks,
+                    lambda_generate,
+                    addLine,
+                    variables,
                 )
-            if not addLine:
-                OBJS.append(lambda_generate(zipped))
-            else:
-                OBJS.append(lambda_generate(zipped, i))
+            )
+        except STATEMENT_ERRORS as e:
+            # Given a problem list, a bad statement is noted and left out so
+            # the rest of the plan still gets checked
+            if problems is None:
+                raise
+            noteProblem(problems, statement, e)
 
     return OBJS
 
 
-def parseAnyForRoom(
-    src, room, start, required, lambda_checks, lambda_generate, addLine=False
-):
-    def same_room(zipped):
-        return zipped["room"] == room
-
+def parseAnyForRoom(index, room, kind, required, lambda_checks, lambda_generate):
     return parseAny(
-        src, start, required, (*lambda_checks, same_room), lambda_generate, addLine
+        index.forRoom(kind, room),
+        required,
+        lambda_checks,
+        lambda_generate,
+        True,
+        index.variables,
+        index.problems,
     )
 
 
-def parseBoxesForRoom(src, room):
-    start = "new box"
-    required = ["room", "name", "anchor"]
+def parseBoxesForRoom(index, room):
+    kind = "box"
+    required = ROOM_OBJECT_KEYWORDS[kind]
 
     def correct_color(zipped):
         if not "color" in zipped:
@@ -431,20 +1026,21 @@ def parseBoxesForRoom(src, room):
         correct_color,
     ]
 
-    def generate(zipped):
+    def generate(zipped, statement):
         return Box(
             zipped["room"],
             zipped["name"],
             [int(n) for n in zipped["anchor"].split(",")],
             zipped["color"],
+            statement.linen,
         )
 
-    return parseAnyForRoom(src, room, start, required, checks, generate)
+    return parseAnyForRoom(index, room, kind, required, checks, generate)
 
 
-def parseDoorsForRoom(src, room):
-    start = "new door"
-    required = ["room", "on", "at"]
+def parseDoorsForRoom(index, room):
+    kind = "door"
+    required = ROOM_OBJECT_KEYWORDS[kind]
 
     def validate_positions(zipped):
         if zipped["on"] not in ["left", "right", "top", "bottom"]:
@@ -455,15 +1051,15 @@ def parseDoorsForRoom(src, room):
         validate_positions,
     ]
 
-    def generate(zipped):
-        return Door(zipped["room"], zipped["on"], zipped["at"])
+    def generate(zipped, statement):
+        return Door(zipped["room"], zipped["on"], zipped["at"], statement.linen)
 
-    return parseAnyForRoom(src, room, start, required, checks, generate)
+    return parseAnyForRoom(index, room, kind, required, checks, generate)
 
 
-def parseCablesForRoom(src, room):
-    start = "new cable"
-    required = ["room", "type", "size", "from", "to"]
+def parseCablesForRoom(index, room):
+    kind = "cable"
+    required = ROOM_OBJECT_KEYWORDS[kind]
 
     def validate_type(zipped):
         if zipped["type"] not in ["V", "H"]:
@@ -490,31 +1086,106 @@ def parseCablesForRoom(src, room):
 
     checks = [validate_type, validate_malformed_cables, validate_size]
 
-    def generate(zipped):
+    def generate(zipped, statement):
         return Cable(
             zipped["room"],
             zipped["size"],
             [int(n) for n in zipped["from"].split(",")],
             [int(n) for n in zipped["to"].split(",")],
             zipped["type"] == "V",
+            statement.linen,
         )
 
-    return parseAnyForRoom(src, room, start, required, checks, generate)
+    return parseAnyForRoom(index, room, kind, required, checks, generate)
 
 
-def parseVariables(src):
-    start = "set var"
+def parseRoutesForRoom(index, room, width, height, boxes, doors):
+    kind = "route"
+    required = ROOM_OBJECT_KEYWORDS[kind]
+    statements = index.forRoom(kind, room)
+    if not statements:
+        return []
+    router = Router(
+        int(height) * Const.ROOM_SIZE, int(width) * Const.ROOM_SIZE, boxes, doors
+    )
+
+    def validate_boxes(zipped):
+        if zipped["from"] not in router.boxes or zipped["to"] not in router.boxes:
+            return False
+        return True
+
+    def validate_distinct(zipped):
+        # A route from a cell to itself would be a cable of no length
+        if router.boxes[zipped["from"]] == router.boxes[zipped["to"]]:
+            return False
+        return True
+
+    def validate_inside(zipped):
+        for name in (zipped["from"], zipped["to"]):
+            if not router.inside(*router.boxes[name]):
+                assert False, (
+                    'Box "'
+                    + name
+                    + '" is outside room '
+                    + str(room)
+                    + ", no cable can be routed to it"
+                )
+        return True
+
+    def validate_size(zipped):
+        if int(zipped["size"]) <= 0:
+            return False
+        return True
+
+    checks = [validate_boxes, validate_distinct, validate_inside, validate_size]
+
+    def generate(zipped, statement):
+        path = router.route(zipped["from"], zipped["to"])
+        if path is None:
+            assert False, (
+                'No route from "'
+                + zipped["from"]
+                + '" to "'
+                + zipped["to"]
+                + '" in room '
+                + str(room)
+            )
+        return [
+            Cable(
+                zipped["room"],
+                zipped["size"],
+                list(start),
+                list(end),
+                start[0] == end[0],
+                statement.linen,
+            )
+            for start, end in routeSegments(path)
+        ]
+
+    routed = []
+    for cables in parseAny(
+        statements, required, checks, generate, True, index.variables, index.problems
+    ):
+        routed.extend(cables)
+    return routed
+
+
+def parseVariables(index):
     required = ["name", "value"]
     checks = []
 
-    def generate(zipped, linen):
-        return Variable(zipped["name"], zipped["value"], linen)
+    def generate(zipped, statement):
+        return Variable(zipped["name"], zipped["value"], statement.order)
+
+    for variable in parseAny(
+        index.of("var"), required, checks, generate, True, problems=index.problems
+    ):
+        index.variables.add(variable)
 
-    return parseAny(src, start, required, checks, generate, True)
+    return index.variables
 
 
-def parseMath(src):
-    start = "do math"
+def parseMath(index):
     required = ["by", "into"]
 
     def validate_operators(zipped):
@@ -526,41 +1197,343 @@ def parseMath(src):
         validate_operators,
     ]
 
-    def generate(zipped, linen):
-        global variables
+    def generate(zipped, statement):
         if "times" in zipped:
-            variables.append(
-                Variable(
-                    zipped["into"], int(zipped["times"]) * int(zipped["by"]), linen
-                )
-            )
+            value = int(zipped["times"]) * int(zipped["by"])
         elif "divide" in zipped:
-            variables.append(
-                Variable(
-                    zipped["into"], int(zipped["divide"]) // int(zipped["by"]), linen
-                )
-            )
+            value = int(zipped["divide"]) // int(zipped["by"])
         elif "sum" in zipped:
-            variables.append(
-                Variable(zipped["into"], int(zipped["sum"]) + int(zipped["by"]), linen)
-            )
+            value = int(zipped["sum"]) + int(zipped["by"])
         else:
-            variables.append(
-                Variable(
-                    zipped["into"], int(zipped["subtract"]) - int(zipped["by"]), linen
+            value = int(zipped["subtract"]) - int(zipped["by"])
+        # Later math can refer to this result, so define it right away
+        variable = Variable(zipped["into"], value, statement.order)
+        index.variables.add(variable)
+        return variable
+
+    return parseAny(
+        index.of("math"),
+        required,
+        checks,
+        generate,
+        True,
+        index.variables,
+        index.problems,
+    )
+
+
+def cellCapacity():
+    # Strands sit 4 pixels apart, past this many they spill into the next cell
+    return Const.CELL_SIZE // 4 - 1
+
+
+def lineLabel(linen):
+    # Statement lines count from 0 in the expanded source
+    return "?" if linen is None else str(linen + 1)
+
+
+def cableColumns(cables):
+    if isinstance(cables, CableArray):
+        # The array columns are handed to NumPy without going through views
+        return (
+            numpy.array(cables.start_x, dtype=numpy.int64),
+            numpy.array(cables.start_y, dtype=numpy.int64),
+            numpy.array(cables.end_x, dtype=numpy.int64),
+            numpy.array(cables.end_y, dtype=numpy.int64),
+            numpy.array(cables.size, dtype=numpy.int64),
+            numpy.array(cables.vertical, dtype=bool),
+        )
+    return (
+        numpy.array([c.start[0] for c in cables], dtype=numpy.int64),
+        numpy.array([c.start[1] for c in cables], dtype=numpy.int64),
+        numpy.array([c.end[0] for c in cables], dtype=numpy.int64),
+        numpy.array([c.end[1] for c in cables], dtype=numpy.int64),
+        numpy.array([c.size for c in cables], dtype=numpy.int64),
+        numpy.array([c.is_vertical for c in cables], dtype=bool),
+    )
+
+
+def doorCells(door, rows, columns):
+    # A door spans the two cells either side of its "at" line
+    a = door.at
+    if door.on == "left":
+        return [(a - 1, 0), (a, 0)]
+    if door.on == "right":
+        return [(a - 1, columns - 1), (a, columns - 1)]
+    if door.on == "top":
+        return [(0, a - 1), (0, a)]
+    return [(rows - 1, a - 1), (rows - 1, a)]
+
+
+class OccupancyGrid:
+    # Cell contents of one room, indexed [row, column] like the cell grid.
+    # Cables are painted as segments, so every query is linear in the number
+    # of cables and cells instead of comparing cables pairwise
+    def __init__(self, room):
+        self.room = room
+        self.rows = room.height * Const.ROOM_SIZE
+        self.columns = room.width * Const.ROOM_SIZE
+        shape = (self.rows, self.columns)
+
+        # Index of the first box in every cell, -1 when empty
+        self.boxes = numpy.full(shape, -1, dtype=numpy.int32)
+        self.box_count = numpy.zeros(shape, dtype=numpy.int32)
+        for i, box in reversed(list(enumerate(room.boxes))):
+            x, y = box.anchor[0], box.anchor[1]
+            if self.inside(y, x):
+                self.boxes[y, x] = i
+                self.box_count[y, x] += 1
+
+        self.doors = numpy.full(shape, -1, dtype=numpy.int32)
+        for i, door in enumerate(room.doors):
+            for y, x in doorCells(door, self.rows, self.columns):
+                if self.inside(y, x):
+                    self.doors[y, x] = i
+
+        sx, sy, ex, ey, size, vertical = cableColumns(room.cables)
+        self.vertical = vertical
+        # Vertical cables run along a column, horizontal ones along a row
+        self.fixed = numpy.where(vertical, sx, sy)
+        self.low = numpy.minimum(
+            numpy.where(vertical, sy, sx), numpy.where(vertical, ey, ex)
+        )
+        self.high = numpy.maximum(
+            numpy.where(vertical, sy, sx), numpy.where(vertical, ey, ex)
+        )
+        self.size = size
+        self.inside_room = (
+            (numpy.minimum(sx, ex) >= 0)
+            & (numpy.maximum(sx, ex) < self.columns)
+            & (numpy.minimum(sy, ey) >= 0)
+            & (numpy.maximum(sy, ey) < self.rows)
+        )
+        # Strands running through every cell, per direction
+        self.load_vertical = self.paintLoad(True)
+        self.load_horizontal = self.paintLoad(False)
+
+    def inside(self, y, x):
+        return 0 <= y < self.rows and 0 <= x < self.columns
+
+    def paintLoad(self, vertical):
+        # Difference array: +size where a segment starts and -size one cell
+        # past its end, a cumulative sum along the segments fills them in
+        pick = self.inside_room & (self.vertical == vertical)
+        fixed, low, high = self.fixed[pick], self.low[pick], self.high[pick]
+        size = self.size[pick]
+        if vertical:
+            diff = numpy.zeros((self.rows + 1, self.columns), dtype=numpy.int64)
+            numpy.add.at(diff, (low, fixed), size)
+            numpy.add.at(diff, (high + 1, fixed), -size)
+            return numpy.cumsum(diff, axis=0)[:-1]
+        diff = numpy.zeros((self.rows, self.columns + 1), dtype=numpy.int64)
+        numpy.add.at(diff, (fixed, low), size)
+        numpy.add.at(diff, (fixed, high + 1), -size)
+        return numpy.cumsum(diff, axis=1)[:, :-1]
+
+    def segmentHits(self, mask, ends=True):
+        # Marked cells under every cable, from prefix sums along both axes.
+        # Without ends, the first and last cell of every cable are skipped
+        shift = 0 if ends else 1
+        hits = numpy.zeros(len(self.size), dtype=numpy.int64)
+        down = numpy.zeros((self.rows + 1, self.columns), dtype=numpy.int64)
+        down[1:] = numpy.cumsum(mask, axis=0)
+        across = numpy.zeros((self.rows, self.columns + 1), dtype=numpy.int64)
+        across[:, 1:] = numpy.cumsum(mask, axis=1)
+        for vertical, prefix in ((True, down), (False, across)):
+            pick = self.inside_room & (self.vertical == vertical)
+            fixed, low, high = self.fixed[pick], self.low[pick], self.high[pick]
+            low, high = low + shift, high + 1 - shift
+            if vertical:
+                hits[pick] = prefix[high, fixed] - prefix[low, fixed]
+            else:
+                hits[pick] = prefix[fixed, high] - prefix[fixed, low]
+        # One cell long cables have no inside, their difference goes negative
+        return numpy.maximum(hits, 0)
+
+    def cells(self, i, ends=True):
+        # Cells of one cable, in [row, column] order
+        shift = 0 if ends else 1
+        fixed, low, high = self.fixed[i], self.low[i], self.high[i]
+        for along in range(low + shift, high + 1 - shift):
+            yield (along, fixed) if self.vertical[i] else (fixed, along)
+
+    def load(self):
+        return self.load_vertical + self.load_horizontal
+
+    def overflow(self):
+        capacity = cellCapacity()
+        return (self.load_vertical > capacity) | (self.load_horizontal > capacity)
+
+
+def roomViolations(room):
+    grid = OccupancyGrid(room)
+    label = "room " + str(room.uid)
+    cables = room.cables
+    violations = []
+
+    for i, box in enumerate(room.boxes):
+        x, y = box.anchor[0], box.anchor[1]
+        if not grid.inside(y, x):
+            violations.append(
+                (box.linen, label + ': box "{}" is outside the room'.format(box.name))
+            )
+        elif grid.box_count[y, x] > 1 and grid.boxes[y, x] != i:
+            other = room.boxes[int(grid.boxes[y, x])]
+            violations.append(
+                (
+                    box.linen,
+                    label
+                    + ': box "{}" overlaps box "{}" at {},{}'.format(
+                        box.name, other.name, x, y
+                    ),
+                )
+            )
+    for door in room.doors:
+        if not all(
+            grid.inside(y, x) for y, x in doorCells(door, grid.rows, grid.columns)
+        ):
+            violations.append(
+                (
+                    door.linen,
+                    label
+                    + ": {} door at {} is outside the wall".format(door.on, door.at),
                 )
             )
+    if not len(cables):
+        return violations
 
-    return parseAny(src, start, required, checks, generate, True)
+    for i in numpy.flatnonzero(~grid.inside_room):
+        violations.append(
+            (cables[int(i)].linen, label + ": cable runs outside the room")
+        )
+    # Cables may start or end on a box, that is where they plug in
+    checks = [
+        (
+            False,
+            grid.boxes >= 0,
+            lambda y, x: 'cable runs through box "{}" at {},{}'.format(
+                room.boxes[int(grid.boxes[y, x])].name, x, y
+            ),
+        ),
+        (
+            True,
+            grid.doors >= 0,
+            lambda y, x: "cable blocks the {} door at {},{}".format(
+                room.doors[int(grid.doors[y, x])].on, x, y
+            ),
+        ),
+        (
+            True,
+            grid.overflow(),
+            lambda y, x: "cable tray over capacity at {},{} ({} of {} strands)".format(
+                x,
+                y,
+                max(grid.load_vertical[y, x], grid.load_horizontal[y, x]),
+                cellCapacity(),
+            ),
+        ),
+    ]
+    for ends, mask, describe in checks:
+        # Only the few cables that hit something are walked cell by cell
+        for i in numpy.flatnonzero(grid.segmentHits(mask, ends)):
+            y, x = next(cell for cell in grid.cells(i, ends) if mask[cell])
+            violations.append((cables[int(i)].linen, label + ": " + describe(y, x)))
+    return violations
 
 
-def drawRooms(rooms):
-    for room in rooms:
-        drawRoom(room)
-    drawFullRoom(rooms)
+def formatProblems(problems):
+    problems = sorted(problems, key=lambda p: -1 if p[0] is None else p[0])
+    return ["line " + lineLabel(linen) + ": " + text for linen, text in problems]
 
 
-def drawFullRoom(rooms):
+def validateRooms(rooms):
+    assert numpy is not None, "Validation needs NumPy to be installed"
+    violations = []
+    for room in rooms:
+        violations.extend(roomViolations(room))
+    return formatProblems(violations)
+
+
+def checkPlan(path):
+    # Front end and room checks only: every problem is collected, nothing is
+    # drawn and nothing is written
+    try:
+        index = StatementIndex(parseConditionals(parseLoops(parseMacros(path))))
+    except AssertionError as e:
+        # Blocks are matched while streaming, past a broken one the rest of
+        # the source cannot be trusted
+        return ["line ?: " + str(e)]
+    except STATEMENT_ERRORS + (OSError,) as e:
+        return ["line ?: " + type(e).__name__ + ": " + str(e)]
+    index.problems = []
+    parseVariables(index)
+    parseMath(index)
+    rooms = parseRooms(index)
+    if numpy is not None:
+        for room in rooms:
+            index.problems.extend(roomViolations(room))
+    return formatProblems(index.problems)
+
+
+def savePng(image, path, **params):
+    image.save(path, **params)
+    if TIMER.profiling:
+        TIMER.count("files written")
+        TIMER.count("png bytes encoded", os.path.getsize(path))
+
+
+def pngBytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def loadPng(path):
+    if TIMER.profiling:
+        TIMER.count("files opened")
+        TIMER.count("png bytes decoded", os.path.getsize(path))
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+def drawRoomBuffer(room, cell_size=Const.CELL_SIZE):
+    # Raw pixels are cheaper to send back from a worker than a pickled Image
+    image = drawRoom(room, cell_size)
+    return image.size, image.tobytes()
+
+
+def renderRooms(rooms, jobs=1, cell_size=Const.CELL_SIZE):
+    if jobs <= 1:
+        for room in rooms:
+            yield drawRoom(room, cell_size)
+        return
+
+    chunksize = max(1, len(rooms) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=configureRender, initargs=(renderSettings(),)
+    ) as executor:
+        # map yields in submission order, so compositing stays deterministic
+        draw = functools.partial(drawRoomBuffer, cell_size=cell_size)
+        for size, data in executor.map(draw, rooms, chunksize=chunksize):
+            yield Image.frombytes("RGB", size, data)
+
+
+def drawRooms(rooms, room_images=False, jobs=1, cache=None, cell_size=Const.CELL_SIZE):
+    if cache is not None:
+        drawCachedRooms(rooms, room_images, jobs, cache, cell_size)
+        return
+
+    def draw():
+        for room, image in zip(rooms, renderRooms(rooms, jobs, cell_size)):
+            if room_images:
+                savePng(image, str(room.uid) + ".png")
+            yield image
+
+    # Rooms are drawn as they are pasted, so only one of them is alive at a time
+    drawFullRoom(rooms, draw(), cell_size)
+
+
+def floorSize(rooms, cell_size=Const.CELL_SIZE):
     maxX = -1
     maxXwidth = -1
     maxY = -1
@@ -575,213 +1548,1618 @@ def drawFullRoom(rooms):
             if room.height >= maxYheight:
                 maxYheight = room.height
 
-    image = Image.new(
-        mode="RGB",
-        size=(
-            (maxX + maxXwidth) * Const.ROOM_SIZE * Const.CELL_SIZE,
-            (maxY + maxYheight) * Const.ROOM_SIZE * Const.CELL_SIZE,
-        ),
-        color=Const.WHITE,
+    return (
+        (maxX + maxXwidth) * Const.ROOM_SIZE * cell_size,
+        (maxY + maxYheight) * Const.ROOM_SIZE * cell_size,
     )
-    for room in rooms:
-        image.paste(
-            Image.open(str(room.uid) + ".png", "r"),
-            (
-                room.anchor[0] * Const.ROOM_SIZE * Const.CELL_SIZE,
-                room.anchor[1] * Const.ROOM_SIZE * Const.CELL_SIZE,
-            ),
-        )
+
+
+def roomBounds(room, cell_size=Const.CELL_SIZE):
+    x = room.anchor[0] * Const.ROOM_SIZE * cell_size
+    y = room.anchor[1] * Const.ROOM_SIZE * cell_size
+    return (
+        x,
+        y,
+        x + room.width * Const.ROOM_SIZE * cell_size,
+        y + room.height * Const.ROOM_SIZE * cell_size,
+    )
+
+
+def fullDoorLines(room, cell_size=Const.CELL_SIZE):
+    c = cell_size
+    x, y, right, bottom = roomBounds(room, c)
+    for door in room.doors:
+        a = door.at
+        if door.on == "left":
+            yield ((x, (a - 1) * c), (x, (a + 1) * c))
+        elif door.on == "right":
+            yield ((right, (a - 1) * c), (right, (a + 1) * c))
+        elif door.on == "top":
+            yield (((a - 1) * c, y), ((a + 1) * c, y))
+        elif door.on == "bottom":
+            yield (((a - 1) * c, bottom), ((a + 1) * c, bottom))
+
+
+def composeFloor(rooms, images, cell_size=Const.CELL_SIZE):
+    image = Image.new(mode="RGB", size=floorSize(rooms, cell_size), color=Const.WHITE)
+    for room, room_image in zip(rooms, images):
+        image.paste(room_image, roomBounds(room, cell_size)[:2])
     draw = ImageDraw.Draw(image)
     for room in rooms:
-        width = room.width * Const.ROOM_SIZE * Const.CELL_SIZE
-        height = room.height * Const.ROOM_SIZE * Const.CELL_SIZE
-        x = room.anchor[0] * Const.ROOM_SIZE * Const.CELL_SIZE
-        y = room.anchor[1] * Const.ROOM_SIZE * Const.CELL_SIZE
-        for door in room.doors:
-            o = door.on
-            a = door.at
-            if door.on == "left":
-                draw.line(
-                    (
-                        (x, (a - 1) * Const.CELL_SIZE),
-                        (x, (a + 1) * Const.CELL_SIZE),
-                    ),
-                    fill=Const.GRAY_LIGHT,
-                    width=6,
-                )
-            elif door.on == "right":
-                draw.line(
-                    (
-                        (width + x, (a - 1) * Const.CELL_SIZE),
-                        (width + x, (a + 1) * Const.CELL_SIZE),
-                    ),
-                    fill=Const.GRAY_LIGHT,
-                    width=6,
-                )
-            elif door.on == "top":
-                draw.line(
-                    (
-                        ((a - 1) * Const.CELL_SIZE, y),
-                        ((a + 1) * Const.CELL_SIZE, y),
-                    ),
-                    fill=Const.GRAY_LIGHT,
-                    width=6,
+        for line in fullDoorLines(room, cell_size):
+            draw.line(line, fill=Const.GRAY_LIGHT, width=lineWidth(6, cell_size))
+    return image
+
+
+def drawFullRoom(rooms, images, cell_size=Const.CELL_SIZE):
+    image = composeFloor(rooms, images, cell_size)
+    savePng(image, "full.png")
+    return image
+
+
+def doorBounds(line):
+    # Door strokes are 6 pixels wide, so pad their boxes by a few pixels
+    margin = 4
+    (x0, y0), (x1, y1) = line
+    return (
+        min(x0, x1) - margin,
+        min(y0, y1) - margin,
+        max(x0, x1) + margin,
+        max(y0, y1) + margin,
+    )
+
+
+class TileGrid:
+    def __init__(self, width, height, tile_size):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.columns = -(-width // tile_size)
+        self.rows = -(-height // tile_size)
+        self.cells = {}
+
+    def span(self, bounds):
+        left, top, right, bottom = bounds
+        first_column = max(0, left // self.tile_size)
+        last_column = min(self.columns - 1, (right - 1) // self.tile_size)
+        first_row = max(0, top // self.tile_size)
+        last_row = min(self.rows - 1, (bottom - 1) // self.tile_size)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                yield column, row
+
+    def add(self, bounds, item):
+        # Files the item under every tile its bounding box touches
+        for cell in self.span(bounds):
+            self.cells.setdefault(cell, []).append(item)
+
+    def at(self, column, row):
+        return self.cells.get((column, row), [])
+
+    def query(self, bounds):
+        found = set()
+        for cell in self.span(bounds):
+            found.update(self.cells.get(cell, []))
+        return sorted(found)
+
+
+def floorGrids(rooms, width, height, tile_size, cell_size=Const.CELL_SIZE):
+    room_grid = TileGrid(width, height, tile_size)
+    door_grid = TileGrid(width, height, tile_size)
+    for i, room in enumerate(rooms):
+        room_grid.add(roomBounds(room, cell_size), i)
+        for line in fullDoorLines(room, cell_size):
+            door_grid.add(doorBounds(line), line)
+    return room_grid, door_grid
+
+
+def drawRegion(
+    rooms, room_indexes, door_lines, bounds, roomImage, cell_size=Const.CELL_SIZE
+):
+    left, top, right, bottom = bounds
+    region = Image.new(mode="RGB", size=(right - left, bottom - top), color=Const.WHITE)
+    # Indexes come in room order, so overlaps paste as in full.png
+    for i in room_indexes:
+        x, y = roomBounds(rooms[i], cell_size)[:2]
+        region.paste(roomImage(i), (x - left, y - top))
+    draw = ImageDraw.Draw(region)
+    for (x0, y0), (x1, y1) in door_lines:
+        draw.line(
+            ((x0 - left, y0 - top), (x1 - left, y1 - top)),
+            fill=Const.GRAY_LIGHT,
+            width=lineWidth(6, cell_size),
+        )
+    return region
+
+
+def floorLevel(rooms, tile_size, cell_size=Const.CELL_SIZE):
+    # Size of the floor at a cell size and the rooms and doors of its tiles
+    width, height = floorSize(rooms, cell_size)
+    return (width, height) + floorGrids(rooms, width, height, tile_size, cell_size)
+
+
+def roomLru(draw, size=64):
+    # Rooms spanning several tiles are kept for a while instead of redrawn
+    drawn = collections.OrderedDict()
+
+    def roomImage(i):
+        if i in drawn:
+            drawn.move_to_end(i)
+        else:
+            drawn[i] = draw(i)
+            if len(drawn) > size:
+                drawn.popitem(last=False)
+        return drawn[i]
+
+    return roomImage
+
+
+def drawTile(rooms, level, column, row, roomImage, cell_size=Const.CELL_SIZE):
+    # Tiles that would be blank are None, they are not written and viewers
+    # fill them in
+    width, height, room_grid, door_grid = level
+    tile_rooms = room_grid.at(column, row)
+    tile_doors = door_grid.at(column, row)
+    if not tile_rooms and not tile_doors:
+        return None
+    size = room_grid.tile_size
+    left = column * size
+    top = row * size
+    bounds = (left, top, min(left + size, width), min(top + size, height))
+    return drawRegion(rooms, tile_rooms, tile_doors, bounds, roomImage, cell_size)
+
+
+def drawTiles(
+    rooms,
+    directory,
+    tile_size=1024,
+    cache_size=64,
+    cache=None,
+    cell_size=Const.CELL_SIZE,
+):
+    level = floorLevel(rooms, tile_size, cell_size)
+    width, height, room_grid, _ = level
+    roomImage = roomLru(
+        lambda i: cachedRoom(rooms[i], cache, cell_size=cell_size), cache_size
+    )
+
+    os.makedirs(directory, exist_ok=True)
+    tiles = []
+    for row in range(room_grid.rows):
+        for column in range(room_grid.columns):
+            tile = drawTile(rooms, level, column, row, roomImage, cell_size)
+            if tile is None:
+                continue
+            name = str(column) + "_" + str(row) + ".png"
+            savePng(tile, os.path.join(directory, name))
+            tiles.append(
+                {
+                    "file": name,
+                    "column": column,
+                    "row": row,
+                    "x": column * tile_size,
+                    "y": row * tile_size,
+                    "width": tile.width,
+                    "height": tile.height,
+                }
+            )
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "width": width,
+                "height": height,
+                "tile_size": tile_size,
+                "columns": room_grid.columns,
+                "rows": room_grid.rows,
+                "background": list(Const.WHITE),
+                "tiles": tiles,
+            },
+            f,
+            indent=2,
+        )
+    if cache:
+        cache.trim()
+
+
+class Pyramid:
+    # Per process state of pyramid workers: the rooms, where tiles go and
+    # the room lookups of every level, built once per process
+    rooms = None
+    directory = None
+    tile_size = 256
+    cache_size = 64
+    levels = {}
+
+
+def configurePyramid(settings, rooms, directory, tile_size, cache_size):
+    configureRender(settings)
+    Pyramid.rooms = rooms
+    Pyramid.directory = directory
+    Pyramid.tile_size = tile_size
+    Pyramid.cache_size = cache_size
+    Pyramid.levels = {}
+
+
+def pyramidPath(zoom, column, row):
+    return os.path.join(Pyramid.directory, str(zoom), str(column), str(row) + ".png")
+
+
+def pyramidLevel(zoom, cell_size):
+    if zoom not in Pyramid.levels:
+        Pyramid.levels[zoom] = floorLevel(Pyramid.rooms, Pyramid.tile_size, cell_size)
+    return Pyramid.levels[zoom]
+
+
+def renderPyramidTiles(zoom, cell_size, tiles):
+    # Tiles of a level drawn straight from the model at that level's cell
+    # size. Neighbouring tiles come together, so rooms across them are
+    # drawn once
+    rooms = Pyramid.rooms
+    roomImage = roomLru(lambda i: drawRoom(rooms[i], cell_size), Pyramid.cache_size)
+    level = pyramidLevel(zoom, cell_size)
+    written = []
+    for column, row in tiles:
+        tile = drawTile(rooms, level, column, row, roomImage, cell_size)
+        if tile is None:
+            continue
+        path = pyramidPath(zoom, column, row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        savePng(tile, path)
+        written.append([column, row])
+    return written
+
+
+def reducePyramidTiles(zoom, width, height, tiles, children):
+    # Tiles of a level made from the four tiles under them in the level
+    # above, halved. Tiles missing there were blank
+    size = Pyramid.tile_size
+    written = []
+    for column, row in tiles:
+        parts = [
+            (dx, dy)
+            for dx in (0, 1)
+            for dy in (0, 1)
+            if (2 * column + dx, 2 * row + dy) in children
+        ]
+        if not parts:
+            continue
+        left = 2 * column * size
+        top = 2 * row * size
+        region = Image.new(
+            mode="RGB",
+            size=(min(2 * size, width - left), min(2 * size, height - top)),
+            color=Const.WHITE,
+        )
+        for dx, dy in parts:
+            child = loadPng(pyramidPath(zoom + 1, 2 * column + dx, 2 * row + dy))
+            region.paste(child, (dx * size, dy * size))
+        path = pyramidPath(zoom, column, row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        savePng(region.reduce(2), path)
+        written.append([column, row])
+    return written
+
+
+def pyramidChunks(columns, rows, jobs):
+    # Row major runs of tiles, a few per worker to even out the load
+    tiles = [(column, row) for row in range(rows) for column in range(columns)]
+    count = max(1, min(len(tiles), jobs * 4))
+    step = -(-len(tiles) // count)
+    return [tiles[i : i + step] for i in range(0, len(tiles), step)]
+
+
+def drawPyramid(
+    rooms,
+    directory,
+    tile_size=256,
+    jobs=1,
+    min_cell=4,
+    cache_size=64,
+    cell_size=Const.CELL_SIZE,
+):
+    # Zoom 0 fits one tile, the deepest zoom is the plan at full size. Levels
+    # whose cells are still whole pixels, and at least min_cell of them, are
+    # drawn from the model, smaller ones are halved from the level above.
+    # No level is ever drawn as a whole, only tile by tile
+    full_size = cell_size
+    width, height = floorSize(rooms, full_size)
+    max_zoom = 0
+    while max(width, height) > tile_size << max_zoom:
+        max_zoom += 1
+
+    levels = []
+    sizes = (width, height)
+    for zoom in range(max_zoom, -1, -1):
+        factor = 1 << (max_zoom - zoom)
+        cell_size = None
+        if factor == 1 or (full_size % factor == 0 and full_size // factor >= min_cell):
+            cell_size = full_size // factor
+        if zoom < max_zoom:
+            sizes = (-(-sizes[0] // 2), -(-sizes[1] // 2))
+        levels.append((zoom, cell_size) + sizes)
+
+    settings = renderSettings()
+    os.makedirs(directory, exist_ok=True)
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=configurePyramid,
+            initargs=(settings, rooms, directory, tile_size, cache_size),
+        )
+    else:
+        configurePyramid(settings, rooms, directory, tile_size, cache_size)
+
+    manifest = []
+    children = set()
+    try:
+        for zoom, cell_size, level_width, level_height in levels:
+            columns = -(-level_width // tile_size)
+            rows = -(-level_height // tile_size)
+            chunks = pyramidChunks(columns, rows, jobs)
+            if cell_size is not None:
+                task = functools.partial(renderPyramidTiles, zoom, cell_size)
+            else:
+                # Children are cut from the level above at its own size
+                above = manifest[-1]
+                task = functools.partial(
+                    reducePyramidTiles,
+                    zoom,
+                    above["width"],
+                    above["height"],
+                    children=children,
                 )
-            elif door.on == "bottom":
-                draw.line(
-                    (
-                        ((a - 1) * Const.CELL_SIZE, height + y),
-                        ((a + 1) * Const.CELL_SIZE, height + y),
-                    ),
-                    fill=Const.GRAY_LIGHT,
-                    width=6,
+            if executor is None:
+                written = [tile for chunk in chunks for tile in task(chunk)]
+            else:
+                written = [
+                    tile for tiles in executor.map(task, chunks) for tile in tiles
+                ]
+            children = set(map(tuple, written))
+            manifest.append(
+                {
+                    "zoom": zoom,
+                    "width": level_width,
+                    "height": level_height,
+                    "columns": columns,
+                    "rows": rows,
+                    "cell_size": cell_size,
+                    "source": "model" if cell_size is not None else "reduced",
+                    "tiles": sorted(written),
+                }
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "width": width,
+                "height": height,
+                "tile_size": tile_size,
+                "max_zoom": max_zoom,
+                "path": "{z}/{x}/{y}.png",
+                "background": list(Const.WHITE),
+                "levels": sorted(manifest, key=lambda level: level["zoom"]),
+            },
+            f,
+            indent=2,
+        )
+
+
+# Bump whenever drawRoom changes what it draws, to invalidate cached rooms
+RENDER_VERSION = 2
+
+
+def roomKey(room, cell_size=Const.CELL_SIZE):
+    # Position and uid are left out, they do not change the room image
+    contents = [
+        RENDER_VERSION,
+        sorted((k, v) for k, v in vars(Const).items() if k.isupper()),
+        sorted(
+            [("cell_size", cell_size)]
+            + [(k, v) for k, v in renderSettings().items() if k.startswith("lod")]
+        ),
+        room.width,
+        room.height,
+        [[box.name, box.anchor, box.color] for box in room.boxes],
+        [
+            [cable.size, cable.start, cable.end, cable.is_vertical]
+            for cable in room.cables
+        ],
+        [[door.on, door.at] for door in room.doors],
+    ]
+    return hashlib.sha256(json.dumps(contents).encode()).hexdigest()
+
+
+# Bump when parsing or routing changes the rooms a source turns into
+MODEL_VERSION = 3
+
+
+def modelKey(path):
+    # The source is self contained, macros included, so its bytes and the
+    # versions of the model and its encoding decide the rooms
+    digest = hashlib.sha256()
+    digest.update("model {} json\n".format(MODEL_VERSION).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def dumpRooms(rooms):
+    # Plain lists only, so the format does not depend on the model classes.
+    # JSON and not pickle, a shared cache directory must not run code
+    rooms = [
+        (
+            room.uid,
+            room.width,
+            room.height,
+            list(room.anchor),
+            [
+                (box.room_uid, box.name, list(box.anchor), list(box.color), box.linen)
+                for box in room.boxes
+            ],
+            [
+                (
+                    cable.room_uid,
+                    cable.size,
+                    list(cable.start),
+                    list(cable.end),
+                    cable.is_vertical,
+                    cable.linen,
                 )
-    image.save("full.png")
+                for cable in room.cables
+            ],
+            [(door.room_uid, door.on, door.at, door.linen) for door in room.doors],
+        )
+        for room in rooms
+    ]
+    return zlib.compress(json.dumps(rooms, separators=(",", ":")).encode(), 1)
 
 
-def drawRoom(room):
-    # inverted because of PIL's coordinate system
-    height = room.width * Const.ROOM_SIZE * Const.CELL_SIZE
-    width = room.height * Const.ROOM_SIZE * Const.CELL_SIZE
+def loadRooms(data, compact=False):
+    rooms = []
+    for uid, width, height, anchor, boxes, cables, doors in json.loads(
+        zlib.decompress(data)
+    ):
+        boxes = [Box(*box) for box in boxes]
+        cables = [Cable(*cable) for cable in cables]
+        if compact:
+            boxes = BoxArray(boxes)
+            cables = CableArray(cables)
+        doors = [Door(*door) for door in doors]
+        rooms.append(Room(uid, width, height, anchor, boxes, cables, doors))
+    return rooms
+
+
+class RenderCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".png")
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # The modification time doubles as the last use for eviction
+        os.utime(path)
+        return loadPng(path)
+
+    def put(self, key, image):
+        savePng(image, self.path(key), compress_level=1)
+
+    def copy(self, key, destination):
+        shutil.copyfile(self.path(key), destination)
+
+    def model(self, key, compact=False):
+        path = os.path.join(self.directory, key + ".model")
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return loadRooms(data, compact)
+        except (zlib.error, ValueError, TypeError):
+            # A damaged entry is a miss, it is written again after the build
+            return None
+
+    def putModel(self, key, rooms):
+        path = os.path.join(self.directory, key + ".model")
+        # Written aside and renamed, a concurrent run never reads half a file
+        with open(path + ".tmp", "wb") as f:
+            f.write(dumpRooms(rooms))
+        os.replace(path + ".tmp", path)
+
+    def layout(self):
+        path = os.path.join(self.directory, "layout.json")
+        if not os.path.exists(path) or not os.path.exists(self.path("full")):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def full(self):
+        return loadPng(self.path("full"))
+
+    def restoreFull(self, destination):
+        shutil.copyfile(self.path("full"), destination)
+
+    def saveLayout(self, layout, image, path):
+        # The composite was just encoded to path, copying it is cheaper
+        shutil.copyfile(path, self.path("full"))
+        with open(os.path.join(self.directory, "layout.json"), "w") as f:
+            json.dump(layout, f)
+
+    def trim(self):
+        # Drops the least recently used rooms and models until the cache
+        # fits its cap
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".model") or (
+                entry.name.endswith(".png") and entry.name != "full.png"
+            ):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+class MemoryCache:
+    # Same interface as RenderCache, used to keep state warm in --watch mode
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size = 0
+        self.previous = None
+        self.image = None
+
+    def has(self, key):
+        return key in self.images
+
+    def get(self, key):
+        if key not in self.images:
+            return None
+        self.images.move_to_end(key)
+        return self.images[key]
+
+    def put(self, key, image):
+        if key not in self.images:
+            self.size += image.width * image.height * 3
+        self.images[key] = image
+
+    def copy(self, key, destination):
+        savePng(self.images[key], destination)
+
+    def layout(self):
+        return self.previous
+
+    def full(self):
+        return self.image
+
+    def restoreFull(self, destination):
+        if not os.path.exists(destination):
+            savePng(self.image, destination)
+
+    def saveLayout(self, layout, image, path):
+        self.previous = layout
+        self.image = image
+
+    def trim(self):
+        while self.size > self.max_bytes and self.images:
+            _, image = self.images.popitem(last=False)
+            self.size -= image.width * image.height * 3
+
+
+def cachedRoom(room, cache, key=None, cell_size=Const.CELL_SIZE):
+    if cache is None:
+        return drawRoom(room, cell_size)
+    key = key or roomKey(room, cell_size)
+    image = cache.get(key)
+    if image is None:
+        image = drawRoom(room, cell_size)
+        cache.put(key, image)
+    return image
+
+
+def floorLayout(rooms, keys, cell_size=Const.CELL_SIZE):
+    return {
+        "size": list(floorSize(rooms, cell_size)),
+        "rooms": [
+            [list(roomBounds(room, cell_size)), key] for room, key in zip(rooms, keys)
+        ],
+        "doors": [
+            list(doorBounds(line))
+            for room in rooms
+            for line in fullDoorLines(room, cell_size)
+        ],
+    }
+
+
+def boundsOverlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def dirtyRects(previous, layout):
+    # Anything present in only one of the two layouts has to be redrawn
+    old = collections.Counter(
+        [(tuple(bounds), key) for bounds, key in previous["rooms"]]
+        + [(tuple(bounds), None) for bounds in previous["doors"]]
+    )
+    new = collections.Counter(
+        [(tuple(bounds), key) for bounds, key in layout["rooms"]]
+        + [(tuple(bounds), None) for bounds in layout["doors"]]
+    )
+    width, height = layout["size"]
+    rects = set()
+    for bounds, _ in (old - new) + (new - old):
+        left, top, right, bottom = bounds
+        rect = (max(0, left), max(0, top), min(width, right), min(height, bottom))
+        if rect[0] < rect[2] and rect[1] < rect[3]:
+            rects.add(rect)
+    return sorted(rects)
+
+
+def drawCachedRooms(rooms, room_images, jobs, cache, cell_size=Const.CELL_SIZE):
+    keys = [roomKey(room, cell_size) for room in rooms]
+    layout = floorLayout(rooms, keys, cell_size)
+    previous = cache.layout()
+
+    if previous is None or previous["size"] != layout["size"]:
+        # Nothing to patch, composite everything, rendering cache misses only
+        missing = {}
+        for room, key in zip(rooms, keys):
+            if key not in missing and not cache.has(key):
+                missing[key] = room
+        rendered = renderRooms(list(missing.values()), jobs, cell_size)
+
+        def draw():
+            for key in keys:
+                image = cache.get(key)
+                if image is None:
+                    image = next(rendered)
+                    cache.put(key, image)
+                yield image
+
+        image = drawFullRoom(rooms, draw(), cell_size)
+    elif not dirtyRects(previous, layout):
+        image = None
+        cache.restoreFull("full.png")
+    else:
+        # Only the rectangles that changed since the last run are redrawn
+        width, height = layout["size"]
+        room_grid, door_grid = floorGrids(rooms, width, height, 1024, cell_size)
+        image = cache.full()
+        for rect in dirtyRects(previous, layout):
+            indexes = [
+                i
+                for i in room_grid.query(rect)
+                if boundsOverlap(roomBounds(rooms[i], cell_size), rect)
+            ]
+            doors = [
+                line
+                for line in door_grid.query(rect)
+                if boundsOverlap(doorBounds(line), rect)
+            ]
+            region = drawRegion(
+                rooms,
+                indexes,
+                doors,
+                rect,
+                lambda i: cachedRoom(rooms[i], cache, keys[i], cell_size),
+                cell_size,
+            )
+            image.paste(region, rect[:2])
+        savePng(image, "full.png")
 
-    step_count = height / Const.CELL_SIZE
+    if room_images:
+        for room, key in zip(rooms, keys):
+            if not cache.has(key):
+                cache.put(key, drawRoom(room, cell_size))
+            cache.copy(key, str(room.uid) + ".png")
+    if image is not None:
+        cache.saveLayout(layout, image, "full.png")
+    cache.trim()
+
+
+@functools.lru_cache(maxsize=16)
+def gridTemplate(height, width, cell_size, grid=True, wall=3):
     image = Image.new(mode="RGB", size=(height, width), color=Const.WHITE)
+    if grid:
+        # One pre-rendered cell is tiled into a strip, and the strip into the
+        # room
+        cell = Image.new(mode="RGB", size=(cell_size, cell_size), color=Const.WHITE)
+        cell_draw = ImageDraw.Draw(cell)
+        cell_draw.line(((0, 0), (0, cell_size)), fill=Const.GRAY_LIGHT)
+        cell_draw.line(((0, 0), (cell_size, 0)), fill=Const.GRAY_LIGHT)
+        strip = Image.new(mode="RGB", size=(height, cell_size), color=Const.WHITE)
+        for x in range(0, height, cell_size):
+            strip.paste(cell, (x, 0))
+        for y in range(0, width, cell_size):
+            image.paste(strip, (0, y))
+
     draw = ImageDraw.Draw(image)
-    y_start = 0
-    y_end = image.height
-    step_size = int(image.width / step_count)
-    for x in range(0, image.width, step_size):
-        line = ((x, y_start), (x, y_end))
-        draw.line(line, fill=Const.GRAY_LIGHT)
-    x_start = 0
-    x_end = image.width
-    for y in range(0, image.height, step_size):
-        line = ((x_start, y), (x_end, y))
-        draw.line(line, fill=Const.GRAY_LIGHT)
-    draw.line(((0, 0), (height, 0)), fill=0, width=3)
-    draw.line(((0, 0), (0, width)), fill=0, width=3)
-    draw.line(((height, width), (height, 0)), fill=0, width=3)
-    draw.line(((height, width), (0, width)), fill=0, width=3)
+    draw.line(((0, 0), (height, 0)), fill=0, width=wall)
+    draw.line(((0, 0), (0, width)), fill=0, width=wall)
+    draw.line(((height, width), (height, 0)), fill=0, width=wall)
+    draw.line(((height, width), (0, width)), fill=0, width=wall)
+    return image
+
+
+def drawRoom(room, cell_size=Const.CELL_SIZE):
+    # inverted because of PIL's coordinate system
+    c = cell_size
+    height = room.width * Const.ROOM_SIZE * c
+    width = room.height * Const.ROOM_SIZE * c
+
+    # The grid and walls only depend on the size, rooms start from a copy
+    with TIMER.stage("grid"):
+        template = gridTemplate(height, width, c, c >= Render.lod_grid, lineWidth(3, c))
+    # Copying the canvas to and from NumPy only pays off on busy rooms, which
+    # are only busy at full size
+    strands = sum(cable.size for cable in room.cables)
+    if c < Render.lod_strands:
+        strands = len(room.cables)
+    if Render.numpy and strands >= Render.numpy_strands and c == Const.CELL_SIZE:
+        if TIMER.profiling:
+            TIMER.count("draw calls", 2 * len(room.boxes))
+            TIMER.count("rooms rasterized")
+        return rasterizeRoom(template, room, height, width)
+    if TIMER.profiling:
+        # A rectangle and a label per box, a line per strand and per door
+        TIMER.count("draw calls", 2 * len(room.boxes) + strands + len(room.doors))
+    image = template.copy()
+    drawRoomContents(ImageDraw.Draw(image), room, height, width, c)
+
+    return image
+
+
+def boxRect(box, c=Const.CELL_SIZE):
+    a = box.anchor
+    return (a[0] * c, a[1] * c, a[0] * c + c, a[1] * c + c)
+
+
+def boxLabel(box, c=Const.CELL_SIZE):
+    a = box.anchor
+    return (a[0] * c + c // 8, a[1] * c + c * 3 // 8)
+
+
+def cableStrands(cable, c=Const.CELL_SIZE):
+    s = cable.start
+    e = cable.end
+    gap = strandGap(c)
+    if c < Render.lod_strands:
+        # Strands would merge anyway, the cable becomes one stroke down the
+        # middle of its cells
+        half = c // 2
+        yield (
+            (s[0] * c + half, s[1] * c + half),
+            (e[0] * c + half, e[1] * c + half),
+        ), Const.RED_NORMAL
+        return
+    for i in range(1, cable.size + 1):
+        fill = Const.RED_NORMAL if i == 1 else Const.RED_DARK
+        if cable.is_vertical:
+            yield (
+                (s[0] * c + gap * i, s[1] * c + gap),
+                (e[0] * c + gap * i, e[1] * c + gap),
+            ), fill
+        else:
+            yield (
+                (s[0] * c + gap, s[1] * c + gap * i),
+                (e[0] * c + gap, e[1] * c + gap * i),
+            ), fill
+
+
+def roomDoorLines(room, height, width, c=Const.CELL_SIZE):
+    for door in room.doors:
+        a = door.at
+        if door.on == "left":
+            yield ((0, (a - 1) * c), (0, (a + 1) * c))
+        elif door.on == "right":
+            yield ((width, (a - 1) * c), (width, (a + 1) * c))
+        elif door.on == "top":
+            yield (((a - 1) * c, 0), ((a + 1) * c, 0))
+        elif door.on == "bottom":
+            yield (((a - 1) * c, height), ((a + 1) * c, height))
+
 
+@functools.lru_cache(maxsize=None)
+def labelFont():
+    # Every new canvas would load Pillow's default font again for its first
+    # label, so one is shared by the whole process
+    return ImageFont.load_default()
+
+
+def drawBoxes(draw, room, c=Const.CELL_SIZE):
     for box in room.boxes:
-        a = box.anchor
-        draw.rectangle(
-            (
-                a[0] * Const.CELL_SIZE,
-                a[1] * Const.CELL_SIZE,
-                a[0] * Const.CELL_SIZE + Const.CELL_SIZE,
-                a[1] * Const.CELL_SIZE + Const.CELL_SIZE,
-            ),
-            fill=tuple(box.color),
-            outline=(0),
-        )
-        draw.text(
-            (a[0] * Const.CELL_SIZE + 4, a[1] * Const.CELL_SIZE + 12),
-            box.name,
-            Const.WHITE,
-        )
+        draw.rectangle(boxRect(box, c), fill=tuple(box.color), outline=(0))
+        if c >= Render.lod_labels:
+            draw.text(boxLabel(box, c), box.name, Const.WHITE, font=labelFont())
+
+
+def drawRoomContents(draw, room, height, width, c=Const.CELL_SIZE):
+    # draw only needs ImageDraw's line, rectangle and text, so any backend
+    # offering them (see SvgDraw) shares the room drawing rules
+    drawBoxes(draw, room, c)
     for cable in room.cables:
+        for line, fill in cableStrands(cable, c):
+            draw.line(line, fill=fill, width=1)
+    for line in roomDoorLines(room, height, width, c):
+        draw.line(line, fill=Const.GRAY_LIGHT, width=lineWidth(5, c))
+
+
+def fillRect(canvas, x0, y0, x1, y1, color):
+    # Inclusive bounds like PIL's rectangle, clipped to the canvas
+    x0 = max(x0, 0)
+    y0 = max(y0, 0)
+    x1 = min(x1, canvas.shape[1] - 1)
+    y1 = min(y1, canvas.shape[0] - 1)
+    if x0 <= x1 and y0 <= y1:
+        canvas[y0 : y1 + 1, x0 : x1 + 1] = color
+
+
+def strokeRect(line, width):
+    # Pixels PIL covers for an axis aligned line of odd width
+    (x0, y0), (x1, y1) = line
+    if (x0, y0) == (x1, y1):
+        return x0, y0, x1, y1
+    half = width // 2
+    if x0 == x1:
+        return x0 - half, min(y0, y1), x0 + half, max(y0, y1)
+    return min(x0, x1), y0 - half, max(x0, x1), y0 + half
+
+
+def paintStrands(canvas, cables):
+    height, width = canvas.shape[:2]
+    # Strands are painted as palette indexes into one byte per pixel, which
+    # is much cheaper to write than RGB, and colored in one pass at the end
+    palette = numpy.array(
+        [Const.WHITE, Const.RED_NORMAL, Const.RED_DARK], dtype=numpy.uint8
+    )
+    codes = numpy.zeros((height, width), dtype=numpy.uint8)
+    for cable in cables:
         s = cable.start
         e = cable.end
+        # Cables are straight, so their strands are parallel runs 4 pixels
+        # apart, written together as one strided slice per color
         if cable.is_vertical:
-            for i in range(1, cable.size + 1):
-                draw.line(
-                    (
-                        (s[0] * Const.CELL_SIZE + 4 * i, s[1] * Const.CELL_SIZE + 4),
-                        (e[0] * Const.CELL_SIZE + 4 * i, e[1] * Const.CELL_SIZE + 4),
-                    ),
-                    fill=Const.RED_NORMAL if i == 1 else Const.RED_DARK,
-                    width=1,
-                )
+            base, a, b = s[0], s[1], e[1]
+            across, along = width, height
         else:
-            for i in range(1, cable.size + 1):
-                draw.line(
-                    (
-                        (s[0] * Const.CELL_SIZE + 4, s[1] * Const.CELL_SIZE + 4 * i),
-                        (e[0] * Const.CELL_SIZE + 4, e[1] * Const.CELL_SIZE + 4 * i),
-                    ),
-                    fill=Const.RED_NORMAL if i == 1 else Const.RED_DARK,
-                    width=1,
-                )
-    for door in room.doors:
-        o = door.on
-        a = door.at
-        if door.on == "left":
-            draw.line(
-                (
-                    (0, (a - 1) * Const.CELL_SIZE),
-                    (0, (a + 1) * Const.CELL_SIZE),
-                ),
-                fill=Const.GRAY_LIGHT,
-                width=5,
+            base, a, b = s[1], s[0], e[0]
+            across, along = height, width
+        base *= Const.CELL_SIZE
+        low = max(min(a, b) * Const.CELL_SIZE + 4, 0)
+        high = min(max(a, b) * Const.CELL_SIZE + 4, along - 1)
+        # Strand i sits at base + 4 * i, keep those inside the canvas
+        first = max(1, -(base // 4))
+        last = min(cable.size, (across - 1 - base) // 4)
+        if low > high or first > last:
+            continue
+        run = slice(low, high + 1)
+        strands = [(slice(base + 4 * max(first, 2), base + 4 * last + 1, 4), 2)]
+        if first == 1:
+            strands.append((base + 4, 1))
+        for strand, code in strands:
+            if cable.is_vertical:
+                codes[run, strand] = code
+            else:
+                codes[strand, run] = code
+    painted = codes != 0
+    canvas[painted] = palette[codes[painted]]
+
+
+def rasterizeRoom(template, room, height, width):
+    # Same pixels as drawRoomContents. Boxes stay with PIL: each label has to
+    # be blended over its own box before anything else is drawn, and there
+    # are few of them, so only strands and doors go through the array
+    image = template.copy()
+    drawBoxes(ImageDraw.Draw(image), room)
+    canvas = numpy.array(image)
+    paintStrands(canvas, room.cables)
+    for line in roomDoorLines(room, height, width):
+        fillRect(canvas, *strokeRect(line, 5), Const.GRAY_LIGHT)
+
+    return Image.fromarray(canvas)
+
+
+def svgColor(color):
+    # PIL accepts a single int for gray levels, SVG needs the full triplet
+    if isinstance(color, int):
+        color = (color,) * 3
+    return "rgb(" + ",".join(str(c) for c in color) + ")"
+
+
+class SvgDraw:
+    # Collects the ImageDraw calls made by drawRoomContents as SVG elements
+    def __init__(self):
+        self.elements = []
+
+    def line(self, xy, fill=None, width=1):
+        (x0, y0), (x1, y1) = xy
+        self.elements.append(
+            '<line x1="{}" y1="{}" x2="{}" y2="{}" stroke="{}" '
+            'stroke-width="{}"/>'.format(x0, y0, x1, y1, svgColor(fill), width)
+        )
+
+    def rectangle(self, xy, fill=None, outline=None):
+        x0, y0, x1, y1 = xy
+        self.elements.append(
+            '<rect x="{}" y="{}" width="{}" height="{}" fill="{}" '
+            'stroke="{}"/>'.format(
+                x0, y0, x1 - x0, y1 - y0, svgColor(fill), svgColor(outline)
             )
-        elif door.on == "right":
-            draw.line(
-                (
-                    (width, (a - 1) * Const.CELL_SIZE),
-                    (width, (a + 1) * Const.CELL_SIZE),
-                ),
-                fill=Const.GRAY_LIGHT,
-                width=5,
+        )
+
+    def text(self, xy, text, fill=None, font=None):
+        self.elements.append(
+            '<text x="{}" y="{}" fill="{}">{}</text>'.format(
+                xy[0], xy[1], svgColor(fill), xml.sax.saxutils.escape(text)
             )
-        elif door.on == "top":
-            draw.line(
-                (
-                    ((a - 1) * Const.CELL_SIZE, 0),
-                    ((a + 1) * Const.CELL_SIZE, 0),
-                ),
-                fill=Const.GRAY_LIGHT,
-                width=5,
+        )
+
+
+def svgDefs(c=Const.CELL_SIZE):
+    # Grid lines sit on the first pixel of every cell, like the raster grid
+    grid = ""
+    if c >= Render.lod_grid:
+        grid = (
+            "<defs>"
+            '<pattern id="grid" width="{c}" height="{c}" '
+            'patternUnits="userSpaceOnUse">'
+            '<path d="M 0 0.5 H {c} M 0.5 0 V {c}" stroke="{color}" '
+            'stroke-width="1"/>'
+            "</pattern>"
+            "</defs>"
+        ).format(c=c, color=svgColor(Const.GRAY_LIGHT))
+    return (
+        grid + "<style>text { font: 11px monospace; dominant-baseline: hanging; }"
+        "</style>"
+    )
+
+
+def svgDocument(width, height, body, cell_size=Const.CELL_SIZE):
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+        'viewBox="0 0 {0} {1}">'.format(width, height)
+        + svgDefs(cell_size)
+        + '<rect width="100%" height="100%" fill="{}"/>'.format(svgColor(Const.WHITE))
+        + body
+        + "</svg>\n"
+    )
+
+
+def svgRoom(room, cell_size=Const.CELL_SIZE):
+    # inverted because of PIL's coordinate system, kept for the same output
+    c = cell_size
+    height = room.width * Const.ROOM_SIZE * c
+    width = room.height * Const.ROOM_SIZE * c
+
+    draw = SvgDraw()
+    # Below the grid level of detail the room is left white, as in PNG
+    fill = "url(#grid)" if c >= Render.lod_grid else "none"
+    draw.elements.append(
+        '<rect width="{}" height="{}" fill="{}" stroke="{}" '
+        'stroke-width="{}"/>'.format(
+            height, width, fill, svgColor(Const.BLACK), lineWidth(3, c)
+        )
+    )
+    drawRoomContents(draw, room, height, width, c)
+    return "".join(draw.elements)
+
+
+def svgRoomDocument(room, group, cell_size=Const.CELL_SIZE):
+    x, y, right, bottom = roomBounds(room, cell_size)
+    return svgDocument(right - x, bottom - y, group, cell_size)
+
+
+def svgFloor(rooms, groups, cell_size=Const.CELL_SIZE):
+    body = []
+    for room, group in zip(rooms, groups):
+        x, y, right, bottom = roomBounds(room, cell_size)
+        # A nested svg clips its contents to the room, as the raster room does
+        body.append(
+            '<svg x="{}" y="{}" width="{}" height="{}">{}</svg>'.format(
+                x, y, right - x, bottom - y, group
             )
-        elif door.on == "bottom":
-            draw.line(
-                (
-                    ((a - 1) * Const.CELL_SIZE, height),
-                    ((a + 1) * Const.CELL_SIZE, height),
-                ),
-                fill=Const.GRAY_LIGHT,
-                width=5,
+        )
+
+    draw = SvgDraw()
+    for room in rooms:
+        for line in fullDoorLines(room, cell_size):
+            draw.line(line, fill=Const.GRAY_LIGHT, width=lineWidth(6, cell_size))
+    body.extend(draw.elements)
+
+    width, height = floorSize(rooms, cell_size)
+    return svgDocument(width, height, "\n".join(body), cell_size)
+
+
+def drawSvgRooms(rooms, room_images=False, cell_size=Const.CELL_SIZE):
+    groups = [svgRoom(room, cell_size) for room in rooms]
+    if room_images:
+        for room, group in zip(rooms, groups):
+            with open(str(room.uid) + ".svg", "w") as f:
+                f.write(svgRoomDocument(room, group, cell_size))
+    with open("full.svg", "w") as f:
+        f.write(svgFloor(rooms, groups, cell_size))
+
+
+def compileSource(lines):
+    # The whole pipeline on lines already in memory, nothing touches the disk
+    lines = list(numberLines(line.strip() for line in lines))
+    src = expandMacros(lines, collectMacros(lines))
+    index = StatementIndex(parseConditionals(parseLoops(src)))
+    parseVariables(index)
+    parseMath(index)
+    return index
+
+
+class Floor:
+    # Library entry point. A Floor reads no files and writes none, and floors
+    # share no state, so several of them can be handled from threads at once
+    def __init__(self, source, compact=False):
+        if isinstance(source, str):
+            lines = source.splitlines()
+        else:
+            lines = [
+                line.decode() if isinstance(line, bytes) else line for line in source
+            ]
+        self.index = compileSource(lines)
+        self.rooms = parseRooms(self.index, compact)
+
+    def room(self, uid):
+        for room in self.rooms:
+            if str(room.uid) == str(uid):
+                return room
+        assert False, "No room " + str(uid)
+
+    def violations(self):
+        return validateRooms(self.rooms)
+
+    # scale is a fraction of the full size, 0.125 draws cells of 4 pixels
+
+    def image(self, jobs=1, cache=None, scale=1):
+        c = scaledCellSize(scale)
+        if cache is not None:
+            images = (cachedRoom(room, cache, cell_size=c) for room in self.rooms)
+            return composeFloor(self.rooms, images, c)
+        return composeFloor(self.rooms, renderRooms(self.rooms, jobs, c), c)
+
+    def roomImage(self, uid, scale=1):
+        return drawRoom(self.room(uid), scaledCellSize(scale))
+
+    def png(self, jobs=1, scale=1):
+        return pngBytes(self.image(jobs, scale=scale))
+
+    def roomPng(self, uid, scale=1):
+        return pngBytes(self.roomImage(uid, scale))
+
+    def svg(self, scale=1):
+        c = scaledCellSize(scale)
+        return svgFloor(self.rooms, [svgRoom(room, c) for room in self.rooms], c)
+
+    def roomSvg(self, uid, scale=1):
+        c = scaledCellSize(scale)
+        room = self.room(uid)
+        return svgRoomDocument(room, svgRoom(room, c), c)
+
+
+class Batch:
+    # Per process state of --batch workers, kept warm from one file to the next
+    cache = None
+
+
+def configureBatch(settings, cache_bytes):
+    configureRender(settings)
+    Batch.cache = MemoryCache(cache_bytes)
+
+
+def batchInputs(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matches:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def batchDirectories(paths, directory):
+    # One output directory per file, named after it, numbered on clashes
+    seen = set()
+    directories = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        unique = name
+        n = 1
+        while unique in seen:
+            n += 1
+            unique = name + "-" + str(n)
+        seen.add(unique)
+        directories.append(os.path.join(directory, unique))
+    return directories
+
+
+def renderBatchFile(path, directory, options):
+    start = time.perf_counter()
+    result = {"path": path, "rooms": 0, "bytes": 0, "error": None}
+    try:
+        with open(path, "r") as f:
+            floor = Floor(f, options["compact"])
+        result["rooms"] = len(floor.rooms)
+        if options["validate"]:
+            violations = floor.violations()
+            assert not violations, str(len(violations)) + " violations found"
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        if options["format"] == "svg":
+            written.append(os.path.join(directory, "full.svg"))
+            with open(written[-1], "w") as f:
+                f.write(floor.svg(options["scale"]))
+            if options["room_images"]:
+                for room in floor.rooms:
+                    written.append(os.path.join(directory, str(room.uid) + ".svg"))
+                    with open(written[-1], "w") as f:
+                        f.write(floor.roomSvg(room.uid, options["scale"]))
+        else:
+            written.append(os.path.join(directory, "full.png"))
+            image = floor.image(cache=Batch.cache, scale=options["scale"])
+            savePng(image, written[-1])
+            if options["room_images"]:
+                c = scaledCellSize(options["scale"])
+                for room in floor.rooms:
+                    written.append(os.path.join(directory, str(room.uid) + ".png"))
+                    savePng(cachedRoom(room, Batch.cache, cell_size=c), written[-1])
+        result["bytes"] = sum(os.path.getsize(name) for name in written)
+    except Exception as e:
+        # One broken plan should not stop the rest of the batch
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    if Batch.cache is not None:
+        Batch.cache.trim()
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def renderBatch(paths, directory, options, jobs=1, cache_bytes=0):
+    directories = batchDirectories(paths, directory)
+    settings = renderSettings()
+    if jobs <= 1:
+        configureBatch(settings, cache_bytes)
+        for path, output in zip(paths, directories):
+            yield renderBatchFile(path, output, options)
+        return
+
+    # Each worker keeps its own grid templates and room cache across files
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=configureBatch, initargs=(settings, cache_bytes)
+    ) as executor:
+        futures = [
+            executor.submit(renderBatchFile, path, output, options)
+            for path, output in zip(paths, directories)
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def batchSummary(results, seconds):
+    done = [result for result in results if result["error"] is None]
+    rooms = sum(result["rooms"] for result in done)
+    written = sum(result["bytes"] for result in done)
+    lines = [
+        "{} files, {} failed, {} rooms in {:.3f}s".format(
+            len(results), len(results) - len(done), rooms, seconds
+        ),
+        "{:.1f} files/s, {:.1f} rooms/s, {:.1f} MiB written".format(
+            len(results) / seconds if seconds else 0,
+            rooms / seconds if seconds else 0,
+            written / 1024 / 1024,
+        ),
+    ]
+    for result in results:
+        if result["error"] is not None:
+            lines.append("failed {}: {}".format(result["path"], result["error"]))
+    return "\n".join(lines)
+
+
+def renderPlan(rooms, args, cache=None):
+    if args.validate:
+        with TIMER.stage("validate"):
+            violations = validateRooms(rooms)
+        for violation in violations:
+            print(violation)
+        assert not violations, str(len(violations)) + " violations found"
+
+    with TIMER.stage("render"):
+        if args.format == "svg":
+            drawSvgRooms(rooms, args.room_images, args.cell_size)
+        elif args.pyramid:
+            # Levels are reduced from each other, the pyramid is drawn whole
+            drawPyramid(
+                rooms,
+                args.pyramid,
+                args.tile_size,
+                args.jobs,
+                cell_size=args.cell_size,
+            )
+        elif args.tiles:
+            drawTiles(
+                rooms,
+                args.tiles,
+                args.tile_size,
+                cache=cache,
+                cell_size=args.cell_size,
             )
+        else:
+            drawRooms(rooms, args.room_images, args.jobs, cache, args.cell_size)
+
+
+class Watcher:
+    # Keeps every stage of the last build around and redoes only what changed
+    def __init__(self, src, args):
+        self.src = src
+        self.args = args
+        self.stamp = None
+        self.lines = None
+        self.definitions = None
+        self.macros = None
+        self.source = None
+        self.variables = None
+        self.rooms = {}
+        if args.cache:
+            self.cache = RenderCache(args.cache, args.cache_size * 1024 * 1024)
+        else:
+            self.cache = MemoryCache(args.cache_size * 1024 * 1024)
 
-    image.save(str(room.uid) + ".png")
+    def poll(self):
+        try:
+            stat = os.stat(self.src)
+        except OSError:
+            # Editors that save by renaming leave the file missing for a moment
+            return False
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
 
+    def expandSource(self, lines):
+        definitions = {}
+        body = list(splitMacros(numberLines(lines), definitions))
+        # Macros are only compiled again when a definition changed
+        if definitions == self.definitions:
+            macros = self.macros
+        else:
+            macros = {
+                name: dict(macro, template=compileMacro(macro))
+                for name, macro in definitions.items()
+            }
+        source = list(parseConditionals(parseLoops(expandMacros(body, macros))))
+        return definitions, macros, source
+
+    def roomKey(self, index, statement):
+        # A room only depends on its own statements and on the variables
+        uid = statement.zipped.get("id")
+        if uid is None:
+            return None
+        uid = handleVariables(uid, statement.order, index.variables)
+        return (statement.order, statement.linen, statement.line) + tuple(
+            tuple((s.order, s.linen, s.line) for s in index.forRoom(kind, uid))
+            for kind in ROOM_OBJECT_KEYWORDS
+        )
 
-def main():
-    assert len(sys.argv) == 2, "Invalid arguments length"
-    global variables
+    def parseRooms(self, index, variables):
+        previous = self.rooms if variables == self.variables else {}
+        rooms = {}
+        for statement in index.of("room"):
+            key = self.roomKey(index, statement)
+            room = previous.get(key)
+            if room is None:
+                room = parseRoom(index, statement, self.args.compact)
+            rooms[key] = room
+        checkUnplaced(index, list(rooms.values()))
+        return rooms
+
+    def update(self):
+        lines = list(readSource(self.src))
+        if lines == self.lines:
+            return False
+        definitions, macros, source = self.expandSource(lines)
+        if source == self.source:
+            self.lines = lines
+            self.definitions = definitions
+            self.macros = macros
+            return False
 
-    src = parseMacros(sys.argv[1])
+        index = StatementIndex(source)
+        parseVariables(index)
+        parseMath(index)
+        variables = {
+            name: (list(orders), list(values))
+            for name, (orders, values) in index.variables.definitions.items()
+        }
+        parsed = self.parseRooms(index, variables)
+        # Rooms are diffed against the previous build by the cache
+        renderPlan(list(parsed.values()), self.args, self.cache)
+
+        # State only moves forward once the new build went through
+        self.lines = lines
+        self.definitions = definitions
+        self.macros = macros
+        self.source = source
+        self.variables = variables
+        self.rooms = parsed
+        return True
 
-    # Handle nested loops
-    tmp_src = []
-    while True:
-        tmp_src = parseLoops(src)
-        if tmp_src != src:
-            src = tmp_src
-            continue
-        break
-
-    # Handle nested ifs
-    tmp_src = []
-    while True:
-        tmp_src = parseConditionals(src)
-        if tmp_src != src:
-            src = tmp_src
-            continue
-        break
+    def run(self, interval=0.5):
+        while True:
+            if self.poll():
+                start = time.perf_counter()
+                try:
+                    if self.update():
+                        print(
+                            "Rendered {} in {:.3f}s".format(
+                                self.src, time.perf_counter() - start
+                            )
+                        )
+                except Exception as e:
+                    # A half typed plan should not stop the watcher
+                    print("Error in {}: {}".format(self.src, e))
+            time.sleep(interval)
 
-    srcf = "precompiled.src.floor"
-    with open(srcf, "w") as f:
-        f.writelines(src)
+
+def buildRooms(args):
+    # Every stage is a generator, lines flow through them one at a time
+    src = parseMacros(args.src)
+    src = parseLoops(src)
+    src = parseConditionals(src)
+
+    with TIMER.stage("parse"):
+        if args.materialize:
+            src = list(src)
+            with open("precompiled.src.floor", "w") as f:
+                f.writelines(line + "\n" for _, line in src)
+        index = StatementIndex(src)
 
     # Vars and Consts can be parsed only after the src is flattened
-    variables = parseVariables(srcf)
-    parseMath(srcf)
+    with TIMER.stage("variables"):
+        parseVariables(index)
+        parseMath(index)
+
+    with TIMER.stage("rooms"):
+        rooms = parseRooms(index, args.compact)
+    if TIMER.profiling:
+        TIMER.count("variable lookups", index.variables.lookups)
+    return rooms
 
-    rooms = parseRooms(srcf)
-    drawRooms(rooms)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a .floor plan")
+    parser.add_argument(
+        "src", nargs="+", help="floor file to render, or files and globs with --batch"
+    )
+    parser.add_argument(
+        "--materialize",
+        action="store_true",
+        help="expand the whole source in memory and write it to "
+        "precompiled.src.floor before parsing, for debugging",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["png", "svg"],
+        default="png",
+        help="raster output (full.png) or vector output (full.svg)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="store cables and boxes in per room arrays to save memory",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="draw at this fraction of the full size, e.g. 0.125 for previews",
+    )
+    parser.add_argument(
+        "--numpy",
+        action="store_true",
+        help="draw cables and doors of rooms with "
+        + str(Render.numpy_strands)
+        + "+ strands with NumPy at full size, boxes stay with PIL (same pixels)",
+    )
+    parser.add_argument(
+        "--room-images",
+        action="store_true",
+        help="also write every room to <uid>.png (or <uid>.svg)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="render rooms across N processes",
+    )
+    parser.add_argument(
+        "--tiles",
+        metavar="DIR",
+        help="write the plan as PNG tiles plus manifest.json into DIR "
+        "instead of a single full.png",
+    )
+    parser.add_argument(
+        "--pyramid",
+        metavar="DIR",
+        help="write the plan as a zoomable pyramid of DIR/z/x/y.png tiles "
+        "plus manifest.json, across --jobs processes",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        metavar="PX",
+        help="side of a tile in pixels (default: 1024, 256 with --pyramid)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="keep rendered rooms in DIR and only redraw what changed",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        metavar="MB",
+        help="size cap of the room cache (default: 256)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and render again whenever the file changes",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="check cables against boxes, doors and tray capacity before "
+        "rendering (needs NumPy)",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="render every given file or glob, --jobs of them at a time",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default="batch",
+        metavar="DIR",
+        help="--batch writes every plan into DIR/<file name> (default: batch)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only parse and validate, list every problem with its line and "
+        "write nothing",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="print the time spent in every stage",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="JSON",
+        help="print time, peak memory and event counts of every stage, "
+        "or write them to JSON",
+    )
+    args = parser.parse_args()
+
+    if args.batch:
+        ignored = [
+            flag
+            for flag, used in (
+                ("--cache", args.cache),
+                ("--tiles", args.tiles),
+                ("--pyramid", args.pyramid),
+                ("--timings", args.timings),
+                ("--profile", args.profile is not None),
+            )
+            if used
+        ]
+        assert not ignored, "--batch cannot be used with " + ", ".join(ignored)
+    if args.numpy:
+        assert numpy is not None, "--numpy needs NumPy to be installed"
+        Render.numpy = True
+    if args.profile is not None:
+        TIMER.profile()
+    assert args.scale > 0, "--scale must be positive"
+    args.cell_size = scaledCellSize(args.scale)
+    if args.tile_size is None:
+        # Web map viewers expect 256 pixel tiles
+        args.tile_size = 256 if args.pyramid else 1024
+
+    if args.batch:
+        paths = batchInputs(args.src)
+        options = {
+            "format": args.format,
+            "room_images": args.room_images,
+            "compact": args.compact,
+            "validate": args.validate,
+            "scale": args.scale,
+        }
+        start = time.perf_counter()
+        cache_bytes = args.cache_size * 1024 * 1024
+        results = list(
+            renderBatch(paths, args.output_dir, options, args.jobs, cache_bytes)
+        )
+        print(batchSummary(results, time.perf_counter() - start))
+        failed = sum(1 for result in results if result["error"] is not None)
+        assert not failed, str(failed) + " files failed"
+        return
+
+    if args.check:
+        # Several files are fine here, a hook passes every staged plan
+        found = 0
+        for path in batchInputs(args.src):
+            problems = checkPlan(path)
+            for problem in problems:
+                print(path + ": " + problem)
+            found += len(problems)
+        if numpy is None:
+            print("Layout checks skipped, they need NumPy to be installed")
+        if found:
+            raise SystemExit(str(found) + " problems found")
+        return
+
+    assert len(args.src) == 1, "Several files can only be rendered with --batch"
+    args.src = args.src[0]
+
+    if args.watch:
+        try:
+            Watcher(args.src, args).run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    cache = None
+    if args.cache:
+        cache = RenderCache(args.cache, args.cache_size * 1024 * 1024)
+
+    # A cached model skips the whole front end. --materialize is about
+    # seeing the expanded source, so it always runs it
+    rooms = None
+    model = None
+    if cache is not None and not args.materialize:
+        with TIMER.stage("model"):
+            model = modelKey(args.src)
+            rooms = cache.model(model, args.compact)
+    if rooms is None:
+        rooms = buildRooms(args)
+        if model is not None:
+            cache.putModel(model, rooms)
+
+    renderPlan(rooms, args, cache)
+
+    if args.timings:
+        # grid is part of render, with --jobs it only covers this process
+        print(TIMER.report())
+    if args.profile:
+        with open(args.profile, "w") as f:
+            json.dump(TIMER.profileData(), f, indent=2)
+    elif args.profile is not None:
+        print(TIMER.profileReport())
 
 
 if __name__ == "__main__":
-    variables = []
     main()
@@ -0,0 +1,286 @@
+import concurrent.futures
+
+import pytest
+
+import floorplanner
+
+PLAN = """set var name w value 2
+do math sum @w@ by 1 into w3
+new macro pc params r,x,y equals
+new box room @r@ name PC anchor @x@,@y@ color 0,0,255
+stop macro pc
+new room id 1 width @w@ height 1 anchor 0,0
+new room id 2 width @w3@ height 2 anchor 2,0
+pc r 1 x 2 y 2
+pc r 2 x 5 y 5
+new box room 2 name SW anchor 20,1
+new loop times 3 index i equals
+new cable room 1 type H size 3 from 1,@i@ to 10,@i@
+stop loop
+new cable room 2 type V size 2 from 3,1 to 3,12
+route cable room 2 from PC to SW size 2
+new door room 1 on left at 3
+new door room 2 on top at 4
+"""
+
+
+def writePlan(tmp_path, source=PLAN):
+    path = tmp_path / "plan.floor"
+    path.write_text(source)
+    return str(path)
+
+
+def roomPixels(rooms):
+    return [floorplanner.drawRoom(room).tobytes() for room in rooms]
+
+
+def test_model_cache_round_trip(tmp_path):
+    path = writePlan(tmp_path)
+    rooms = floorplanner.Floor(PLAN).rooms
+    cache = floorplanner.RenderCache(str(tmp_path / "cache"), 0)
+    key = floorplanner.modelKey(path)
+    assert cache.model(key) is None
+    cache.putModel(key, rooms)
+    loaded = cache.model(key)
+    assert floorplanner.dumpRooms(loaded) == floorplanner.dumpRooms(rooms)
+    assert roomPixels(loaded) == roomPixels(rooms)
+
+
+def test_model_key_changes_with_source(tmp_path):
+    key = floorplanner.modelKey(writePlan(tmp_path))
+    edited = PLAN.replace("anchor 0,0", "anchor 1,0")
+    assert len(edited) == len(PLAN)
+    assert floorplanner.modelKey(writePlan(tmp_path, edited)) != key
+
+
+def test_model_key_changes_with_version(tmp_path, monkeypatch):
+    path = writePlan(tmp_path)
+    key = floorplanner.modelKey(path)
+    monkeypatch.setattr(floorplanner, "MODEL_VERSION", floorplanner.MODEL_VERSION + 1)
+    assert floorplanner.modelKey(path) != key
+
+
+def test_model_cache_compact_load(tmp_path):
+    rooms = floorplanner.Floor(PLAN).rooms
+    cache = floorplanner.RenderCache(str(tmp_path / "cache"), 0)
+    cache.putModel("plan", rooms)
+    loaded = cache.model("plan", compact=True)
+    assert isinstance(loaded[0].cables, floorplanner.CableArray)
+    assert roomPixels(loaded) == roomPixels(rooms)
+
+
+def test_model_cache_damaged_entry(tmp_path):
+    cache = floorplanner.RenderCache(str(tmp_path / "cache"), 0)
+    (tmp_path / "cache" / "plan.model").write_bytes(b"not a model")
+    assert cache.model("plan") is None
+
+
+def test_check_reports_front_end_errors(tmp_path):
+    loop = writePlan(tmp_path, "new loop times @n@ index i equals\nstop loop\n")
+    problems = floorplanner.checkPlan(loop)
+    assert len(problems) == 1 and problems[0].startswith("line ?: ValueError")
+    missing = str(tmp_path / "missing.floor")
+    assert floorplanner.checkPlan(missing)[0].startswith("line ?: FileNotFoundError")
+
+
+def test_check_reports_division_by_zero(tmp_path):
+    problems = floorplanner.checkPlan(
+        writePlan(tmp_path, "do math divide 4 by 0 into z\n")
+    )
+    assert problems == [
+        'line 1: integer division or modulo by zero: "do math divide 4 by 0 into z"'
+    ]
+
+
+def test_check_reports_conditional_by_zero(tmp_path):
+    source = "new if multiple 3 of 0 equals\nstop if\n"
+    problems = floorplanner.checkPlan(writePlan(tmp_path, source))
+    assert len(problems) == 1 and problems[0].startswith("line ?: ZeroDivisionError")
+
+
+def test_check_reports_number_used_as_coordinates(tmp_path):
+    source = (
+        "do math sum 1 by 2 into a\n"
+        "new room id 1 width 1 height 1 anchor 0,0\n"
+        "new box room 1 name X anchor @a@\n"
+    )
+    problems = floorplanner.checkPlan(writePlan(tmp_path, source))
+    assert len(problems) == 1 and problems[0].startswith("line 3: 'int' object")
+
+
+def test_check_reports_statements_without_room(tmp_path):
+    source = "new room id 1 width 1 height 1 anchor 0,0\nnew box name X anchor 1,1\n"
+    problems = floorplanner.checkPlan(writePlan(tmp_path, source))
+    assert problems == ['line 2: Invalid creation syntax: "new box name X anchor 1,1"']
+
+
+def test_check_reports_file_line_numbers(tmp_path):
+    source = (
+        "new macro pc params r,x equals\n"
+        "new box room @r@ name PC anchor @x@,1\n"
+        "new box room @r@ name PC2 anchor @x@,2\n"
+        "stop macro pc\n"
+        "new room id 1 width 1 height 1 anchor 0,0\n"
+        "pc r 1 x 1\n"
+        "new loop times 2 index i equals\n"
+        "new cable room 1 type H size 1 from 0,@i@ to 20,@i@\n"
+        "stop loop\n"
+        "route cable room 1 from PC to NOPE size 1\n"
+        "new box room 1 name PC3 anchor 1,1\n"
+    )
+    problems = floorplanner.checkPlan(writePlan(tmp_path, source))
+    assert [problem.split(":")[0] for problem in problems] == [
+        "line 8",
+        "line 8",
+        "line 10",
+        "line 11",
+    ]
+    assert problems[0] == "line 8: room 1: cable runs outside the room"
+
+
+def test_floor_scale_is_per_call():
+    floor = floorplanner.Floor(PLAN)
+    full = floor.image()
+    preview = floor.image(scale=0.125)
+    assert preview.size == (full.width // 8, full.height // 8)
+    assert floor.image().tobytes() == full.tobytes()
+    assert 'stroke-width="1"' in floor.svg(scale=0.125)
+    assert "url(#grid)" not in floor.svg(scale=0.125)
+
+
+def test_floor_scales_from_threads():
+    floor = floorplanner.Floor(PLAN)
+    scales = [1, 0.5, 0.25, 0.125] * 4
+    expected = {scale: floor.image(scale=scale).tobytes() for scale in set(scales)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        images = list(executor.map(lambda scale: floor.image(scale=scale), scales))
+    assert [image.tobytes() for image in images] == [expected[s] for s in scales]
+
+
+ROUTE_ROOM = "new room id 1 width 1 height 1 anchor 0,0\n"
+
+
+def routedCables(source):
+    floor = floorplanner.Floor(ROUTE_ROOM + source)
+    return [
+        (list(cable.start), list(cable.end), cable.is_vertical)
+        for cable in floor.room(1).cables
+    ]
+
+
+def cableCells(cables):
+    cells = set()
+    for start, end, _ in cables:
+        for x in range(min(start[0], end[0]), max(start[0], end[0]) + 1):
+            for y in range(min(start[1], end[1]), max(start[1], end[1]) + 1):
+                cells.add((x, y))
+    return cells
+
+
+def cableLength(cables):
+    return sum(
+        abs(end[0] - start[0]) + abs(end[1] - start[1]) for start, end, _ in cables
+    )
+
+
+def test_route_is_shortest_with_fewest_bends():
+    cables = routedCables(
+        "new box room 1 name A anchor 1,1\n"
+        "new box room 1 name B anchor 6,5\n"
+        "route cable room 1 from A to B size 1\n"
+    )
+    assert cableLength(cables) == 9
+    assert len(cables) == 2
+
+
+def test_route_avoids_boxes():
+    cables = routedCables(
+        "new box room 1 name A anchor 1,1\n"
+        "new box room 1 name B anchor 5,1\n"
+        "new box room 1 name X anchor 3,1\n"
+        "route cable room 1 from A to B size 1\n"
+    )
+    assert (3, 1) not in cableCells(cables)
+    assert cableLength(cables) == 6
+    assert len(cables) == 3
+
+
+def test_route_avoids_doors():
+    # The door on the top wall at 3 covers cells 2,0 and 3,0
+    cables = routedCables(
+        "new box room 1 name A anchor 0,0\n"
+        "new box room 1 name B anchor 5,0\n"
+        "new door room 1 on top at 3\n"
+        "route cable room 1 from A to B size 1\n"
+    )
+    assert not cableCells(cables) & {(2, 0), (3, 0)}
+    assert cableLength(cables) == 7
+
+
+def test_route_without_a_path():
+    source = (
+        "new box room 1 name A anchor 0,0\n"
+        "new box room 1 name X anchor 1,0\n"
+        "new box room 1 name Y anchor 0,1\n"
+        "new box room 1 name B anchor 5,5\n"
+        "route cable room 1 from A to B size 1\n"
+    )
+    with pytest.raises(AssertionError, match='No route from "A" to "B" in room 1'):
+        routedCables(source)
+
+
+def test_route_outside_the_room():
+    source = (
+        "new box room 1 name A anchor 1,1\n"
+        "new box room 1 name OUT anchor -1,0\n"
+        "route cable room 1 from A to OUT size 1\n"
+    )
+    with pytest.raises(AssertionError, match='Box "OUT" is outside room 1'):
+        routedCables(source)
+
+
+def test_route_to_itself():
+    source = (
+        "new box room 1 name A anchor 1,1\n" "route cable room 1 from A to A size 1\n"
+    )
+    with pytest.raises(AssertionError, match="validate_distinct"):
+        routedCables(source)
+
+
+BUSY_ROOM = """new room id 1 width 2 height 2 anchor 0,0
+new box room 1 name A anchor 3,3 color 0,0,255
+new box room 1 name B anchor 15,12
+new door room 1 on left at 5
+new door room 1 on top at 9
+new loop times 40 index i equals
+new cable room 1 type H size 3 from 0,@i@ to 30,@i@
+new cable room 1 type V size 4 from @i@,2 to @i@,45
+stop loop
+new cable room 1 type H size 5 from -3,7 to 60,7
+route cable room 1 from A to B size 2
+"""
+
+
+def test_numpy_room_matches_pillow(monkeypatch):
+    pytest.importorskip("numpy")
+    room = floorplanner.Floor(BUSY_ROOM).room(1)
+    assert sum(cable.size for cable in room.cables) >= floorplanner.Render.numpy_strands
+    expected = floorplanner.drawRoom(room).tobytes()
+    monkeypatch.setattr(floorplanner.Render, "numpy", True)
+    assert floorplanner.drawRoom(room).tobytes() == expected
+
+
+def drawnFiles(directory, rooms, jobs, monkeypatch):
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    floorplanner.drawRooms(rooms, room_images=True, jobs=jobs)
+    return {path.name: path.read_bytes() for path in directory.iterdir()}
+
+
+def test_jobs_output_is_byte_identical(tmp_path, monkeypatch):
+    busy = BUSY_ROOM.replace("id 1", "id 3").replace("anchor 0,0", "anchor 0,1")
+    rooms = floorplanner.Floor(PLAN + busy.replace("room 1", "room 3")).rooms
+    serial = drawnFiles(tmp_path / "serial", rooms, 1, monkeypatch)
+    parallel = drawnFiles(tmp_path / "parallel", rooms, 2, monkeypatch)
+    assert sorted(serial) == ["1.png", "2.png", "3.png", "full.png"]
+    assert parallel == serial